@@ -1,4 +1,6 @@
-from request_handler import RequestHandler, NotFoundException, get_jinja2_env, set_jinja2_env
+from request_handler import RequestHandler, NotFoundException, get_jinja2_env, set_jinja2_env, preload_templates
 from to_xml import to_xml
 import local
+import routing
+from warmup import warmup, WarmupHandler, WARMUP_ROUTE
 import json
@@ -7,10 +7,16 @@ def is_dev():
   _server_software = server_software()
   return not _server_software or 'Development' in _server_software
 
-def branch(choices):
-  """Choose one of the choices based on the environment."""
+def environment():
+  """Returns the name of the current environment, dev or prod."""
+  return 'dev' if is_dev() else 'prod'
+
+def branch(choices, dev=None):
+  """Choose one of the choices based on the environment, or dev if given."""
+  if dev is None:
+    dev = is_dev()
   if choices:
-    if is_dev() and 'dev' in choices:
+    if dev and 'dev' in choices:
       return choices['dev']
     elif 'prod' in choices:
       return choices['prod']
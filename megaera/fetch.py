@@ -1,9 +1,33 @@
+"""Fetching URLs with urlfetch
+
+fetch(url, cached=True) keeps responses in a FetchCache, a bounded in-instance LRU
+cache in front of memcache, as allowed by their Cache-Control and
+Expires headers. Expired responses with an ETag or Last-Modified header
+are revalidated with a conditional request, so an unchanged upstream
+answers with a 304 instead of the body.
+
+iterdecode() decodes a response incrementally, in chunks, with the
+charset given by its BOM, its Content-Type header or its XML or HTML
+meta declaration.
+"""
+
+import codecs
 import re
+import time
+
+from email.utils import parsedate_tz, mktime_tz
 
+from lru import LRUCache
+
+from google.appengine.api import memcache
 from google.appengine.api import urlfetch
 
 
 __charset_rx__ = re.compile('charset=(\S*)', re.IGNORECASE)
+__declared_charset_rx__ = re.compile(
+  r"""<\?xml[^>]*encoding\s*=\s*["']([\w.:-]+)|<meta[^>]*charset\s*=\s*["']?([\w.:-]+)""",
+  re.IGNORECASE)
+__cache_control_rx__ = re.compile('([\w-]+)(?:\s*=\s*"?([^",]*)"?)?')
 
 
 def response_charset(response):
@@ -14,19 +38,342 @@ def response_charset(response):
     if match:
       return match.group(1)
 
-def decode_response(response, default_charset='utf-8'):
-  """Decode a response into unicode, fallback to ASCII."""
+# longest first, the UTF-32 LE BOM starts with the UTF-16 LE BOM
+__BOMS__ = (
+  (codecs.BOM_UTF32_LE, 'utf-32'),
+  (codecs.BOM_UTF32_BE, 'utf-32'),
+  (codecs.BOM_UTF8, 'utf-8-sig'),
+  (codecs.BOM_UTF16_LE, 'utf-16'),
+  (codecs.BOM_UTF16_BE, 'utf-16'),
+)
+
+def sniff_charset(response, default_charset='utf-8'):
+  """Get the charset of a response from its BOM, headers or XML/HTML declaration."""
+  head = response.content[:1024]
+  for bom, charset in __BOMS__:
+    if head.startswith(bom):
+      return charset
+  charset = response_charset(response)
+  if not charset:
+    match = __declared_charset_rx__.search(head)
+    if match:
+      charset = match.group(1) or match.group(2)
+  if charset:
+    try:
+      return codecs.lookup(charset).name
+    except LookupError:
+      pass
+  return default_charset
+
+def decode_response(response, default_charset='utf-8', errors=None):
+  """Decode a response into unicode, fallback to ASCII.
+  
+  If errors is given, e.g., 'strict', 'replace' or 'ignore', the
+  response is decoded with the sniffed charset and errors is the policy
+  for bytes which can't be decoded; the result is always unicode."""
+  if errors is not None:
+    return u''.join(iterdecode(response, default_charset, errors))
   charset = response_charset(response) or default_charset
   try:
     return unicode(response.content, charset)
   except UnicodeDecodeError:
     return response.content
 
-def fetch_decode(url, **kwargs):
-  """Decode the content of a URL."""
-  response = fetch(url)
+def iterdecode(response, default_charset='utf-8', errors='replace', chunk_size=65536):
+  """Decode a response incrementally, yields chunks of unicode."""
+  decoder = codecs.getincrementaldecoder(sniff_charset(response, default_charset))(errors)
+  content = response.content
+  for start in xrange(0, len(content), chunk_size):
+    chunk = decoder.decode(content[start:start + chunk_size])
+    if chunk:
+      yield chunk
+  chunk = decoder.decode('', final=True)
+  if chunk:
+    yield chunk
+
+def fetch_decode(url, cached=False, **kwargs):
+  """Decode the content of a URL, through the fetch cache if cached."""
+  response = fetch(url, cached=cached)
   if response:
+    if isinstance(response, CachedResponse):
+      return response.decode(**kwargs)
     return decode_response(response, **kwargs)
 
-def fetch(url):
-  return urlfetch.fetch(url.replace(' ', '%20'))
+def fetch(url, cached=False):
+  """Fetch a URL, through the fetch cache if cached."""
+  if cached and fetch_cache is not None:
+    return fetch_cache.fetch(url)
+  return urlfetch.fetch(quote_url(url))
+
+def quote_url(url):
+  return url.replace(' ', '%20')
+
+def fetch_many(urls, deadline=None, **kwargs):
+  """Fetch and decode the content of URLs concurrently.
+  
+  Returns a FetchResult for each URL, in order."""
+  return fetch_many_async(urls, deadline=deadline).get_results(**kwargs)
+
+def fetch_many_async(urls, deadline=None):
+  """Start fetching URLs at once, returns a FetchBatch to gather them."""
+  batch = FetchBatch()
+  for url in urls:
+    rpc = urlfetch.create_rpc(deadline=deadline)
+    try:
+      urlfetch.make_fetch_call(rpc, quote_url(url))
+    except urlfetch.Error, e:
+      # e.g., an invalid URL
+      batch.add(url, error=e)
+    else:
+      batch.add(url, rpc=rpc)
+  return batch
+
+
+class FetchResult(object):
+  """The outcome of fetching a URL: its response and decoded content, or an error."""
+  __slots__ = ('url', 'response', 'content', 'error')
+  
+  def __init__(self, url, response=None, content=None, error=None):
+    self.url = url
+    self.response = response
+    self.content = content
+    self.error = error
+  
+  @property
+  def ok(self):
+    return self.error is None
+  
+  @property
+  def status_code(self):
+    if self.response:
+      return self.response.status_code
+  
+  def __repr__(self):
+    return '<FetchResult %s %s>' % (self.url, self.error or self.status_code)
+
+
+class FetchBatch(object):
+  """URL fetches in flight."""
+  
+  def __init__(self):
+    self.fetches = []
+  
+  def add(self, url, rpc=None, error=None):
+    self.fetches.append((url, rpc, error))
+  
+  def get_results(self, **kwargs):
+    """Waits for every fetch, returns a FetchResult for each URL, in order.
+    
+    Errors are reported in the results rather than raised."""
+    results = []
+    for url, rpc, error in self.fetches:
+      if rpc is None:
+        results.append(FetchResult(url, error=error))
+        continue
+      try:
+        response = rpc.get_result()
+      except urlfetch.Error, e:
+        results.append(FetchResult(url, error=e))
+        continue
+      try:
+        content = decode_response(response, **kwargs)
+      except (LookupError, UnicodeError), e:
+        # e.g., an unknown charset
+        results.append(FetchResult(url, response, error=e))
+        continue
+      results.append(FetchResult(url, response, content))
+    return results
+
+
+def parse_cache_control(value):
+  """Returns the directives of a Cache-Control header as a dict."""
+  if not value:
+    return {}
+  return dict((name.lower(), arg) for name, arg in __cache_control_rx__.findall(value))
+
+def parse_http_date(value):
+  """Returns the timestamp of an HTTP date, or None."""
+  parsed = value and parsedate_tz(value)
+  if parsed:
+    return mktime_tz(parsed)
+
+def freshness(headers, now=None):
+  """Returns how many seconds a response may be cached for, or None if it may not be stored."""
+  directives = parse_cache_control(headers.get('cache-control'))
+  if 'no-store' in directives or 'private' in directives:
+    return None
+  if 'no-cache' in directives:
+    return 0
+  for directive in ('s-maxage', 'max-age'):
+    if directives.get(directive):
+      try:
+        return max(int(directives[directive]), 0)
+      except ValueError:
+        return 0
+  expires = parse_http_date(headers.get('expires'))
+  if expires is not None:
+    date = parse_http_date(headers.get('date'))
+    if date is None:
+      date = now or time.time()
+    return max(expires - date, 0)
+  return 0
+
+
+# App Engine memcache rejects larger values
+MEMCACHE_MAX_SIZE = 1000 * 1000
+
+
+class Headers(dict):
+  """Response headers, with case-insensitive names."""
+  
+  def __init__(self, headers=()):
+    super(Headers, self).__init__((key.lower(), value) for key, value in dict(headers).items())
+  
+  def __getitem__(self, key):
+    return super(Headers, self).__getitem__(key.lower())
+  
+  def __setitem__(self, key, value):
+    super(Headers, self).__setitem__(key.lower(), value)
+  
+  def __delitem__(self, key):
+    super(Headers, self).__delitem__(key.lower())
+  
+  def __contains__(self, key):
+    return super(Headers, self).__contains__(key.lower())
+  
+  def get(self, key, default=None):
+    return super(Headers, self).get(key.lower(), default)
+
+
+class CachedResponse(object):
+  """A cached urlfetch response."""
+  
+  def __init__(self, url, content, headers, status_code, expires=0, decoded=None):
+    self.final_url = url
+    self.content = content
+    self.headers = Headers(headers)
+    self.status_code = status_code
+    self.expires = expires
+    # (default charset, errors) -> decoded content
+    self.decoded = {} if decoded is None else decoded
+  
+  @classmethod
+  def from_response(cls, url, response):
+    return cls(getattr(response, 'final_url', None) or url, response.content, response.headers, response.status_code)
+  
+  def copy(self):
+    """Returns a copy for a caller, which shares the decoded content."""
+    return CachedResponse(self.final_url, self.content, self.headers, self.status_code,
+      self.expires, self.decoded)
+  
+  def memcache_value(self):
+    """Returns this response as stored in memcache, without the decoded content."""
+    return (self.final_url, self.content, dict(self.headers), self.status_code, self.expires)
+  
+  def memcache_size(self):
+    return len(self.content) + sum(len(key) + len(value) for key, value in self.headers.iteritems())
+  
+  @property
+  def validators(self):
+    """Returns the headers to revalidate this response with."""
+    headers = {}
+    if self.headers.get('etag'):
+      headers['If-None-Match'] = self.headers['etag']
+    if self.headers.get('last-modified'):
+      headers['If-Modified-Since'] = self.headers['last-modified']
+    return headers
+  
+  def decode(self, default_charset='utf-8', errors=None):
+    """Returns the decoded content, decoded once per charset and errors policy."""
+    key = (default_charset, errors)
+    try:
+      return self.decoded[key]
+    except KeyError:
+      content = self.decoded[key] = decode_response(self, default_charset, errors)
+      return content
+
+
+class FetchCache(object):
+  """An in-instance LRU cache of responses in front of memcache.
+  
+  max_size bounds the total size of the content kept in the instance,
+  in bytes."""
+  
+  def __init__(self, max_size=4 * 1024 * 1024, namespace='fetch-cache', memcache_tier=True, deadline=None):
+    self.local = LRUCache(max_size)
+    self.namespace = namespace
+    self.memcache_tier = memcache_tier
+    self.deadline = deadline
+    # fresh, revalidated (304) and downloaded responses
+    self.hits = 0
+    self.revalidations = 0
+    self.misses = 0
+  
+  def fetch(self, url):
+    """Returns the response for url, a CachedResponse if it may be cached."""
+    now = time.time()
+    cached = self.get(url)
+    if cached is not None and now < cached.expires:
+      self.hits += 1
+      return cached.copy()
+    headers = cached.validators if cached is not None else {}
+    response = urlfetch.fetch(quote_url(url), headers=headers, deadline=self.deadline)
+    if response.status_code == 304 and cached is not None:
+      self.revalidations += 1
+      # fresh again, per the 304's headers
+      lifetime = freshness(Headers(response.headers), now)
+      if lifetime is not None:
+        cached.expires = now + lifetime
+        self.set(url, cached)
+      return cached.copy()
+    self.misses += 1
+    if response.status_code != 200:
+      return response
+    cached_before = cached
+    cached = CachedResponse.from_response(url, response)
+    lifetime = freshness(cached.headers, now)
+    if lifetime is None or not (lifetime or cached.validators):
+      # neither fresh nor revalidatable
+      if cached_before is not None:
+        self.delete(url)
+      return response
+    cached.expires = now + lifetime
+    self.set(url, cached)
+    return cached.copy()
+  
+  def get(self, url):
+    cached = self.local.get(url)
+    if cached is None and self.memcache_tier:
+      stored = memcache.get(url, namespace=self.namespace)
+      if isinstance(stored, tuple) and len(stored) == 5:
+        cached = CachedResponse(*stored)
+        self.local.set(url, cached, size=len(cached.content))
+    return cached
+  
+  def set(self, url, cached):
+    self.local.set(url, cached, size=len(cached.content))
+    if self.memcache_tier:
+      if cached.memcache_size() < MEMCACHE_MAX_SIZE:
+        memcache.set(url, cached.memcache_value(), namespace=self.namespace)
+      else:
+        # too large, and any stored version is stale
+        memcache.delete(url, namespace=self.namespace)
+  
+  def delete(self, url):
+    self.local.delete(url)
+    if self.memcache_tier:
+      memcache.delete(url, namespace=self.namespace)
+  
+  def stats(self):
+    """Returns the hit, revalidation and miss counters and the hit ratio."""
+    total = self.hits + self.revalidations + self.misses
+    return dict(
+      hits=self.hits,
+      revalidations=self.revalidations,
+      misses=self.misses,
+      hit_ratio=total and float(self.hits + self.revalidations) / total,
+      local=self.local.stats())
+
+
+# used by fetch(), None to disable caching
+fetch_cache = FetchCache()
@@ -0,0 +1,277 @@
+"""Two-tier cache for RequestHandler.cache() and cached()
+
+Values are kept in a bounded least-recently-used cache in the instance,
+in front of memcache. Repeated lookups of a hot key are then served
+without an RPC.
+
+Every key has a generation in memcache. An entry is only valid while
+its generation matches the current one, and invalidation replaces the
+generation, so entries held by other instances become stale. A local
+entry re-checks its generation at most every check_interval seconds.
+
+Entries may share the generation of another key, their group, e.g. the
+rendered outputs of a page, so that they are invalidated along with it.
+
+To keep a popular entry which expires from being recomputed by every
+request at once, only the holder of a lease on the key recomputes it.
+Leases are held by one thread per instance and by one instance through
+memcache.add(). Other requests wait for the new value or, when the
+entry was cached with a stale_time, are served the expired value.
+"""
+
+import cPickle as pickle
+import threading
+import time
+import uuid
+
+from lru import LRUCache
+
+from google.appengine.api import memcache
+
+
+NAMESPACE = 'handler-cache'
+
+
+def generation_key(key):
+  return 'generation:%s' % key
+
+def lease_key(key):
+  return 'lease:%s' % key
+
+def new_generation():
+  return uuid.uuid4().hex
+
+
+class _Entry(object):
+  __slots__ = ('group', 'generation', 'expires', 'stale_until', 'data', 'checked')
+
+  def __init__(self, group, generation, expires, stale_until, data, checked):
+    self.group = group
+    self.generation = generation
+    self.expires = expires
+    self.stale_until = stale_until
+    self.data = data
+    self.checked = checked
+
+
+class HandlerCache(object):
+  """An in-instance LRU cache in front of memcache.
+
+  max_size bounds the total size of the pickled values kept in the
+  instance, in bytes."""
+
+  def __init__(self, max_size=4 * 1024 * 1024, check_interval=1.0, namespace=NAMESPACE,
+               lease_time=10, wait_timeout=5.0):
+    self.local = LRUCache(max_size)
+    self.check_interval = check_interval
+    self.namespace = namespace
+    self.lease_time = lease_time
+    self.wait_timeout = wait_timeout
+    # memcache tier
+    self.hits = 0
+    self.misses = 0
+    # keys being recomputed in this instance
+    self._flights = {}
+    self._flights_lock = threading.Lock()
+
+  def get(self, key, group=None):
+    """Returns the fresh value cached for key, or None."""
+    value, fresh = self.lookup(key, group)
+    if fresh:
+      return value
+
+  def lookup(self, key, group=None):
+    """Returns the value cached for key, or None, and whether it is fresh."""
+    return self.lookup_many([key], {key: group})[key]
+
+  def lookup_many(self, keys, groups=None):
+    """Returns a dict of the value cached for each key, or None, and whether it is fresh.
+
+    groups maps keys to their groups. Keys missing from the instance are
+    read from memcache with a single get_multi()."""
+    groups = groups or {}
+    now = time.time()
+    results = {}
+    missing = []
+    checks = {}
+    for key in keys:
+      entry = self.local.get(key)
+      if entry is None:
+        missing.append(key)
+      elif now - entry.checked < self.check_interval:
+        results[key] = self._value(entry, now)
+      else:
+        checks[key] = entry
+    if not (missing or checks):
+      return results
+    gen_keys = set(generation_key(groups.get(key) or key) for key in missing)
+    gen_keys.update(generation_key(entry.group) for entry in checks.itervalues())
+    found = memcache.get_multi(missing + list(gen_keys), namespace=self.namespace)
+    changed = []
+    for key, entry in checks.iteritems():
+      if found.get(generation_key(entry.group)) == entry.generation:
+        entry.checked = now
+        results[key] = self._value(entry, now)
+      else:
+        # changed by another instance
+        self.local.delete(key)
+        changed.append(key)
+    if changed:
+      found.update(memcache.get_multi(changed, namespace=self.namespace))
+    for key in missing + changed:
+      group = groups.get(key) or key
+      stored = found.get(key)
+      if not (isinstance(stored, tuple) and len(stored) == 4 and
+              stored[0] == found.get(generation_key(group))):
+        self.misses += 1
+        results[key] = (None, False)
+        continue
+      self.hits += 1
+      generation, expires, stale_until, data = stored
+      entry = _Entry(group, generation, expires, stale_until, data, now)
+      self._set_local(key, entry)
+      results[key] = self._value(entry, now)
+    return results
+
+  def _value(self, entry, now):
+    return pickle.loads(entry.data), not entry.expires or now < entry.expires
+
+  def set(self, key, value, ttl=0, group=None, stale_time=0):
+    """Caches value for key, to expire after ttl seconds if given.
+    
+    An expired value is still served for stale_time seconds while it is
+    being recomputed."""
+    self.set_many({key: value}, ttl, {key: group}, stale_time)
+
+  def set_many(self, values, ttl=0, groups=None, stale_time=0):
+    """Caches a dict of values by key, with a single set_multi()."""
+    groups = groups or {}
+    now = time.time()
+    generations = self.generations(set(groups.get(key) or key for key in values))
+    expires = ttl and now + ttl
+    stale_until = ttl and now + ttl + stale_time
+    entries = {}
+    for key, value in values.iteritems():
+      group = groups.get(key) or key
+      data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+      entries[key] = _Entry(group, generations[group], expires, stale_until, data, now)
+    memcache.set_multi(
+      dict((key, (entry.generation, expires, stale_until, entry.data))
+           for key, entry in entries.iteritems()),
+      time=ttl and ttl + stale_time, namespace=self.namespace)
+    for key, entry in entries.iteritems():
+      self._set_local(key, entry)
+      # wake up the threads waiting for this value
+      self._finish_flight(key)
+
+  def delete(self, key):
+    """Invalidates key, and the keys in its group, in this and every other instance."""
+    self.delete_many([key])
+
+  def delete_many(self, keys):
+    """Invalidates keys, and the keys in their groups."""
+    keys = set(keys)
+    memcache.set_multi(
+      dict((generation_key(key), new_generation()) for key in keys),
+      namespace=self.namespace)
+    memcache.delete_multi(list(keys), namespace=self.namespace)
+    self.local.delete_matching(lambda entry: entry.group in keys)
+
+  def generation(self, key):
+    """Returns the current generation of key, creating it if needed."""
+    return self.generations([key])[key]
+
+  def generations(self, keys):
+    """Returns a dict of the current generation of each key, creating them if needed."""
+    gen_keys = dict((generation_key(key), key) for key in keys)
+    found = memcache.get_multi(gen_keys.keys(), namespace=self.namespace)
+    created = dict((gen_key, new_generation()) for gen_key in gen_keys if gen_key not in found)
+    if created:
+      found.update(created)
+      # created meanwhile by another instance
+      taken = memcache.add_multi(created, namespace=self.namespace)
+      if taken:
+        found.update(memcache.get_multi(taken, namespace=self.namespace))
+    return dict((key, found.get(gen_key)) for gen_key, key in gen_keys.iteritems())
+
+  def lease(self, key):
+    """Returns if the caller may recompute key, i.e., no other thread or
+    instance is doing so. The lease must be released with release()."""
+    return key in self.lease_many([key])
+
+  def lease_many(self, keys):
+    """Returns the set of keys the caller may recompute, with a single add_multi()."""
+    with self._flights_lock:
+      keys = [key for key in keys if key not in self._flights]
+      for key in keys:
+        self._flights[key] = threading.Event()
+    if not keys:
+      return set()
+    taken = memcache.add_multi(dict((lease_key(key), 1) for key in keys),
+      time=self.lease_time, namespace=self.namespace)
+    leased = set(keys)
+    for key in keys:
+      if lease_key(key) in taken:
+        leased.remove(key)
+        self._finish_flight(key)
+    return leased
+
+  def release(self, key):
+    """Releases the lease on key and wakes up the threads waiting for it."""
+    self.release_many([key])
+
+  def release_many(self, keys):
+    """Releases the leases on keys."""
+    memcache.delete_multi([lease_key(key) for key in keys], namespace=self.namespace)
+    for key in keys:
+      self._finish_flight(key)
+
+  def _finish_flight(self, key):
+    with self._flights_lock:
+      event = self._flights.pop(key, None)
+    if event is not None:
+      event.set()
+
+  def wait(self, key, group=None, timeout=None):
+    """Waits for the holder of the lease on key to cache it, returns the value or None."""
+    if timeout is None:
+      timeout = self.wait_timeout
+    deadline = time.time() + timeout
+    with self._flights_lock:
+      event = self._flights.get(key)
+    if event is not None:
+      # recomputed by another thread in this instance
+      event.wait(timeout)
+      return self.get(key, group)
+    # recomputed by another instance
+    delay = 0.05
+    while True:
+      value = self.get(key, group)
+      if value is not None:
+        return value
+      if memcache.get(lease_key(key), namespace=self.namespace) is None:
+        # released without a value
+        return None
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        return None
+      time.sleep(min(delay, remaining))
+      delay = min(delay * 2, 0.5)
+
+  def _set_local(self, key, entry):
+    ttl = 0
+    if entry.stale_until:
+      ttl = entry.stale_until - time.time()
+      if ttl <= 0:
+        return
+    self.local.set(key, entry, ttl=ttl, size=len(entry.data))
+
+  def clear_local(self):
+    """Empties the in-instance tier."""
+    self.local.clear()
+
+  def stats(self):
+    """Returns the hit and miss counters of both tiers."""
+    return dict(
+      local=self.local.stats(),
+      memcache=dict(hits=self.hits, misses=self.misses))
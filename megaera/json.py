@@ -1,3 +1,4 @@
+import re
 import string
 import types
 
@@ -303,8 +304,478 @@ class JsonWriter(object):
         else:
             raise WriteException, "Cannot write in JSON: %s" % repr(obj)
 
+_ESCAPES = {
+    '\\': r'\\',
+    '"': r'\"',
+    '/': r'\/',
+    '\b': r'\b',
+    '\f': r'\f',
+    '\n': r'\n',
+    '\r': r'\r',
+    '\t': r'\t',
+}
+_ESCAPE_RX = re.compile(r'[\\"\b\f\n\r\t]')
+_ESCAPE_SLASH_RX = re.compile(r'[\\"/\b\f\n\r\t]')
+
+def _escape_char(match):
+    return _ESCAPES[match.group(0)]
+
+class JsonStreamWriter(object):
+    """Single-pass JSON writer.
+
+    Strings are escaped in one pass over a translation table and values are
+    dispatched on their exact type, as in JsonWriter. Output is either
+    returned as a string or flushed in chunks to a file-like object."""
+
+    chunk_parts = 1024
+
+    def __init__(self, escaped_forward_slash=False):
+        if escaped_forward_slash:
+            self._escape_rx = _ESCAPE_SLASH_RX
+        else:
+            self._escape_rx = _ESCAPE_RX
+        self._writers = {
+            types.DictType: self._writeDict,
+            types.ListType: self._writeSequence,
+            types.TupleType: self._writeSequence,
+            types.StringType: self._writeString,
+            types.UnicodeType: self._writeString,
+            types.IntType: self._writeInt,
+            types.LongType: self._writeInt,
+            types.FloatType: self._writeFloat,
+            types.BooleanType: self._writeBool,
+            types.NoneType: self._writeNone,
+        }
+        self._parts = []
+        self._out = None
+
+    def write(self, obj, out=None):
+        """Returns obj as JSON, or writes it to out if given."""
+        self._out = out
+        del self._parts[:]
+        try:
+            self._write(obj)
+            if out is None:
+                return "".join(self._parts)
+            self._flush()
+        finally:
+            self._out = None
+            del self._parts[:]
+
+    def _flush(self):
+        if self._parts:
+            self._out.write("".join(self._parts))
+            del self._parts[:]
+
+    def _write(self, obj):
+        try:
+            writer = self._writers[type(obj)]
+        except KeyError:
+            writer = self._writerFor(obj)
+        writer(obj)
+
+    def _writerFor(self, obj):
+        # dict subclasses are objects, other iterables (e.g. generators)
+        # are arrays
+        if isinstance(obj, dict):
+            writer = self._writeDict
+        elif hasattr(obj, '__iter__'):
+            writer = self._writeSequence
+        else:
+            raise WriteException, "Cannot write in JSON: %s" % repr(obj)
+        self._writers[type(obj)] = writer
+        return writer
+
+    def _writeDict(self, obj):
+        parts = self._parts
+        write = self._write
+        parts.append("{")
+        first = True
+        for k, v in obj.iteritems():
+            if first:
+                first = False
+            else:
+                parts.append(",")
+            write(k)
+            parts.append(":")
+            write(v)
+            if self._out is not None and len(parts) >= self.chunk_parts:
+                self._flush()
+        parts.append("}")
+
+    def _writeSequence(self, obj):
+        parts = self._parts
+        write = self._write
+        parts.append("[")
+        first = True
+        for item in obj:
+            if first:
+                first = False
+            else:
+                parts.append(",")
+            write(item)
+            if self._out is not None and len(parts) >= self.chunk_parts:
+                self._flush()
+        parts.append("]")
+
+    def _writeString(self, obj):
+        self._parts.append('"')
+        if self._escape_rx.search(obj):
+            obj = self._escape_rx.sub(_escape_char, obj)
+        self._parts.append(obj)
+        self._parts.append('"')
+
+    def _writeInt(self, obj):
+        self._parts.append(str(obj))
+
+    def _writeFloat(self, obj):
+        self._parts.append("%f" % obj)
+
+    def _writeBool(self, obj):
+        if obj:
+            self._parts.append("true")
+        else:
+            self._parts.append("false")
+
+    def _writeNone(self, obj):
+        self._parts.append("null")
+
+_WHITESPACE_RX = re.compile(r'(?:\s+|//[^\r\n]*|/\*(?:[^*]|\*(?!/))*\*/)*')
+_WHITESPACE_START = frozenset(' \t\n\r\f\v/')
+_STRING_CHUNK_RX = re.compile(r'([^"\\]*)(["\\])')
+_NUMBER_RX = re.compile(r'-?\d+(\.\d+)?([eE][-+]?\d+)?')
+_NUMBER_TAIL_RX = re.compile(r'(?:\.|[eE][-+]?)\Z')
+_HEX_RX = re.compile(r'[0-9a-fA-F]{4}')
+
+class JsonScanner(object):
+    """Regex-based JSON reader.
+
+    Whitespace, comments, string runs and numbers are matched whole with
+    compiled regexes instead of one character at a time. Errors raise
+    ReadException with the position (and line and column) of the problem."""
+
+    escapes = {'"': '"', '/': '/', '\\': '\\', 'b': '\b', 'f': '\f',
+               'n': '\n', 'r': '\r', 't': '\t'}
+    literals = (('true', True), ('false', False), ('null', None))
+
+    def read(self, s):
+        value, end = self._scan(s, 0)
+        return value
+
+    def _error(self, message, s, pos):
+        line = s.count('\n', 0, pos) + 1
+        column = pos - (s.rfind('\n', 0, pos) + 1) + 1
+        error = ReadException("%s at line %d, column %d (position %d)" %
+                              (message, line, column, pos))
+        error.position = pos
+        error.line = line
+        error.column = column
+        return error
+
+    def _partial(self, s, pos):
+        """Called when the input ends where a value might continue."""
+        pass
+
+    def _end(self, s, pos, message):
+        """Called when the input ends in the middle of a value."""
+        self._partial(s, pos)
+        raise self._error(message, s, pos)
+
+    def _skip(self, s, pos):
+        if s[pos:pos + 1] not in _WHITESPACE_START:
+            return pos
+        pos = _WHITESPACE_RX.match(s, pos).end()
+        if s.startswith('/*', pos):
+            self._end(s, pos, "Not a valid JSON comment, expected */")
+        if pos == len(s) - 1 and s[pos] == '/':
+            self._partial(s, pos)
+        return pos
+
+    def _scan(self, s, pos):
+        pos = self._skip(s, pos)
+        if pos >= len(s):
+            self._end(s, pos, "Nothing to read")
+        ch = s[pos]
+        if ch == '{':
+            return self._scanObject(s, pos + 1)
+        elif ch == '[':
+            return self._scanArray(s, pos + 1)
+        elif ch == '"':
+            return self._scanString(s, pos + 1)
+        elif ch == '-' or ch.isdigit():
+            return self._scanNumber(s, pos)
+        for literal, value in self.literals:
+            if s.startswith(literal, pos):
+                return value, pos + len(literal)
+            if len(s) - pos < len(literal) and literal.startswith(s[pos:]):
+                self._end(s, pos, "Trying to read %s" % literal)
+        raise self._error("Input is not valid JSON", s, pos)
+
+    def _scanNumber(self, s, pos):
+        match = _NUMBER_RX.match(s, pos)
+        if not match:
+            if pos + 1 >= len(s):
+                self._end(s, pos, "Not a valid JSON number")
+            raise self._error("Not a valid JSON number", s, pos)
+        end = match.end()
+        if end >= len(s) or _NUMBER_TAIL_RX.match(s, end):
+            self._partial(s, end)
+        if match.group(1) or match.group(2):
+            return float(match.group(0)), end
+        return int(match.group(0)), end
+
+    def _scanString(self, s, pos):
+        chunks = []
+        append = chunks.append
+        while True:
+            match = _STRING_CHUNK_RX.match(s, pos)
+            if not match:
+                self._end(s, pos, "Not a valid JSON string")
+            content, terminator = match.groups()
+            if content:
+                append(content)
+            pos = match.end()
+            if terminator == '"':
+                return "".join(chunks), pos
+            if pos >= len(s):
+                self._end(s, pos, "Not a valid JSON string")
+            ch = s[pos]
+            if ch == 'u':
+                hex_match = _HEX_RX.match(s, pos + 1)
+                if not hex_match:
+                    if len(s) - pos <= 4:
+                        self._end(s, pos, "Not a valid JSON string")
+                    raise self._error("Not a valid \\u escape", s, pos)
+                append(unichr(int(hex_match.group(0), 16)))
+                pos = hex_match.end()
+            elif ch in self.escapes:
+                append(self.escapes[ch])
+                pos += 1
+            else:
+                raise self._error("Not a valid escaped JSON character: '%s'" % ch, s, pos)
+
+    def _scanArray(self, s, pos):
+        result = []
+        pos = self._skip(s, pos)
+        if s.startswith(']', pos):
+            return result, pos + 1
+        while True:
+            item, pos = self._scan(s, pos)
+            result.append(item)
+            pos = self._skip(s, pos)
+            if pos >= len(s):
+                self._end(s, pos, "Not a valid JSON array")
+            ch = s[pos]
+            pos += 1
+            if ch == ']':
+                return result, pos
+            if ch != ',':
+                raise self._error("Not a valid JSON array due to: '%s'" % ch, s, pos - 1)
+
+    def _scanObject(self, s, pos):
+        result = {}
+        pos = self._skip(s, pos)
+        if s.startswith('}', pos):
+            return result, pos + 1
+        while True:
+            pos = self._skip(s, pos)
+            if pos >= len(s):
+                self._end(s, pos, "Not a valid JSON object")
+            if s[pos] != '"':
+                raise self._error("Not a valid JSON object key (should be a string)", s, pos)
+            key, pos = self._scanString(s, pos + 1)
+            pos = self._skip(s, pos)
+            if pos >= len(s):
+                self._end(s, pos, "Not a valid JSON object")
+            if s[pos] != ':':
+                raise self._error("Not a valid JSON object due to: '%s'" % s[pos], s, pos)
+            result[key], pos = self._scan(s, pos + 1)
+            pos = self._skip(s, pos)
+            if pos >= len(s):
+                self._end(s, pos, "Not a valid JSON object")
+            ch = s[pos]
+            pos += 1
+            if ch == '}':
+                return result, pos
+            if ch != ',':
+                raise self._error("Not a valid JSON object due to: '%s'" % ch, s, pos - 1)
+
+class _Incomplete(Exception):
+    pass
+
+class _IncrementalScanner(JsonScanner):
+    """A JsonScanner over a buffer which may be continued by more input."""
+
+    def __init__(self):
+        self.final = False
+        self.offset = 0
+        self.line = 1
+        self.column = 0
+
+    def consumed(self, text):
+        """Accounts for text dropped from the front of the buffer."""
+        self.offset += len(text)
+        newlines = text.count('\n')
+        if newlines:
+            self.line += newlines
+            self.column = len(text) - text.rfind('\n') - 1
+        else:
+            self.column += len(text)
+
+    def _partial(self, s, pos):
+        if not self.final:
+            raise _Incomplete()
+
+    def _error(self, message, s, pos):
+        line = s.count('\n', 0, pos)
+        if line:
+            column = pos - s.rfind('\n', 0, pos)
+        else:
+            column = self.column + pos + 1
+        pos += self.offset
+        line += self.line
+        error = ReadException("%s at line %d, column %d (position %d)" %
+                              (message, line, column, pos))
+        error.position = pos
+        error.line = line
+        error.column = column
+        return error
+
+class JsonPushParser(object):
+    """Push-style JSON parser which is fed the input in chunks.
+
+    feed() and close() return the values completed so far. With items=True
+    and a top-level array, each element is returned as soon as it has been
+    read and is then dropped from the buffer, so arbitrarily long arrays
+    are read in constant memory. Otherwise the top-level value is returned
+    once it is complete."""
+
+    def __init__(self, items=False):
+        self._items = items
+        self._scanner = _IncrementalScanner()
+        self._buffer = ""
+        self._pos = 0
+        # input not yet joined to the buffer
+        self._chunks = []
+        self._pending = 0
+        self._state = 'start'
+        # the length of the partial value or item last scanned
+        self._attempt = 0
+
+    def feed(self, chunk):
+        """Adds a chunk of input, returns a list of completed values."""
+        if chunk:
+            self._chunks.append(chunk)
+            self._pending += len(chunk)
+        if not self._scanner.final and self._state in ('value', 'item') and \
+                len(self._buffer) - self._pos + self._pending < 2 * self._attempt:
+            # not worth re-scanning the partial value yet, nor joining the input
+            return []
+        if self._pos:
+            self._scanner.consumed(self._buffer[:self._pos])
+            self._buffer = self._buffer[self._pos:]
+            self._pos = 0
+        if self._chunks:
+            self._chunks.insert(0, self._buffer)
+            self._buffer = "".join(self._chunks)
+            self._chunks = []
+            self._pending = 0
+        results = []
+        try:
+            self._parse(results)
+        except _Incomplete:
+            pass
+        return results
+
+    def close(self):
+        """Ends the input, returns a list of the remaining values."""
+        self._scanner.final = True
+        results = self.feed("")
+        if self._state != 'done':
+            self._scanner._end(self._buffer, len(self._buffer), "Unexpected end of JSON input")
+        return results
+
+    def _skip(self):
+        pos = self._scanner._skip(self._buffer, self._pos)
+        if pos >= len(self._buffer):
+            # a trailing // comment might continue in the next chunk
+            self._scanner._partial(self._buffer, pos)
+            return None
+        self._pos = pos
+        return self._buffer[pos]
+
+    def _parse(self, results):
+        scanner = self._scanner
+        buf = self._buffer
+        while True:
+            state = self._state
+            if state == 'start':
+                ch = self._skip()
+                if ch is None:
+                    return
+                if self._items and ch == '[':
+                    self._pos += 1
+                    self._state = 'first'
+                else:
+                    self._state = 'value'
+            elif state == 'value':
+                # re-scanning a partial value is only worth it once its
+                # input has doubled, which keeps the total work linear
+                self._attempt = len(buf) - self._pos
+                value, self._pos = scanner._scan(buf, self._pos)
+                results.append(value)
+                self._state = 'done'
+            elif state == 'first':
+                ch = self._skip()
+                if ch is None:
+                    return
+                if ch == ']':
+                    self._pos += 1
+                    self._state = 'done'
+                else:
+                    self._state = 'item'
+            elif state == 'item':
+                # as for a value
+                self._attempt = len(buf) - self._pos
+                value, self._pos = scanner._scan(buf, self._pos)
+                self._attempt = 0
+                results.append(value)
+                self._state = 'separator'
+            elif state == 'separator':
+                ch = self._skip()
+                if ch is None:
+                    return
+                self._pos += 1
+                if ch == ',':
+                    self._state = 'item'
+                elif ch == ']':
+                    self._state = 'done'
+                else:
+                    raise scanner._error("Not a valid JSON array due to: '%s'" % ch, buf, self._pos - 1)
+            else:
+                return
+
+def iterload(fileobj, items=False, chunk_size=65536):
+    """Reads JSON from a file-like object in chunks.
+
+    Yields the elements of a top-level array if items is true, otherwise
+    yields the top-level value once."""
+    parser = JsonPushParser(items=items)
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        for value in parser.feed(chunk):
+            yield value
+    for value in parser.close():
+        yield value
+
 def write(obj, escaped_forward_slash=False):
-    return JsonWriter().write(obj, escaped_forward_slash)
+    return JsonStreamWriter(escaped_forward_slash).write(obj)
+
+def dump(obj, out, escaped_forward_slash=False):
+    """Writes obj as JSON to the file-like object out."""
+    JsonStreamWriter(escaped_forward_slash).write(obj, out)
 
 def read(s):
-    return JsonReader().read(s)
+    return JsonScanner().read(s)
@@ -20,35 +20,133 @@ In development, this app's local config will be,
 In production, the app's local config will be,
 
   {'pirate': 'ninja', 'robot': 'monkey'}
+
+Parsing YAML is slow on cold starts, so the config can be frozen ahead
+of time into a pickled, already branched file for each environment,
+
+  python megaera/local.py local.yaml
+
+The frozen file is loaded instead of the YAML file, unless it was built
+from a different version of it.
 """
 
-import yaml
+import cPickle as pickle
+import hashlib
 import os
+import sys
 
-from env import branch
+import yaml
 
-from google.appengine.api import memcache
+try:
+  from yaml import CSafeLoader as SafeLoader
+except ImportError:
+  from yaml import SafeLoader
 
+from env import branch, environment, is_dev
 
-def config(filename='local.yaml'):
-  """Return the config (dict) for the current environment."""
-  cachekey = 'config:%s' % filename
-  # check memcache
+
+# also share parsed configs between instances through memcache
+MEMCACHE_TIER = False
+
+# filename -> (stamp, config)
+__CONFIGS__ = {}
+
+
+def stamp(filename):
+  """Returns the mtime and size of filename, or None if it doesn't exist."""
   try:
-    config = memcache.get(cachekey)
-    if config:
-      return config
-  except AssertionError: pass
-  if os.path.exists(filename):
-    config = yaml.load(file(filename).read())
-    # branch each value by environment
-    config = dict([(key, branch(value)) for key, value in config.iteritems()])
+    stat = os.stat(filename)
+  except OSError:
+    return None
+  return (stat.st_mtime, stat.st_size)
+
+def config(filename='local.yaml'):
+  """Return the config (dict) for the current environment.
+  
+  The config is parsed once per process. In development, it is parsed
+  again when the file changes. The dict is shared, don't modify it."""
+  cached = __CONFIGS__.get(filename)
+  if cached is not None and not is_dev():
+    # deployed files don't change
+    return cached[1]
+  current = stamp(filename)
+  if cached is not None and cached[0] == current:
+    return cached[1]
+  config = load(filename, current)
+  __CONFIGS__[filename] = (current, config)
+  return config
+
+def load(filename, current):
+  """Load the config for the current environment, frozen or from YAML."""
+  if current is None:
+    return dict()
+  cachekey = 'config:%s:%s:%s' % ((filename,) + current)
+  if MEMCACHE_TIER:
+    # imported here so that freezing runs outside the SDK
+    from google.appengine.api import memcache
+    try:
+      config = memcache.get(cachekey)
+      if config is not None:
+        return config
+    except AssertionError: pass
+  source = file(filename).read()
+  config = load_frozen(filename, source)
+  if config is None:
+    config = parse(source)
+  if MEMCACHE_TIER:
     try:
       memcache.set(cachekey, config)
     except AssertionError: pass
+  return config
+
+def parse(source, dev=None):
+  """Parse and branch the config for the current environment, or dev if given."""
+  config = yaml.load(source, Loader=SafeLoader) or {}
+  # branch each value by environment
+  return dict([(key, branch(value, dev)) for key, value in config.iteritems()])
+
+def frozen_filename(filename, env=None):
+  """Returns the name of the frozen config for the given or current environment."""
+  return '%s.%s.pickle' % (filename, env or environment())
+
+def load_frozen(filename, source):
+  """Returns the frozen config, or None if it is missing or stale."""
+  try:
+    f = open(frozen_filename(filename), 'rb')
+  except IOError:
+    return None
+  try:
+    digest, config = pickle.load(f)
+  except Exception:
+    return None
+  finally:
+    f.close()
+  if digest == hashlib.sha1(source).hexdigest():
     return config
-  return dict()
 
-def config_get(key):
+def freeze(filename='local.yaml'):
+  """Writes the frozen config for each environment, returns their names."""
+  source = file(filename).read()
+  digest = hashlib.sha1(source).hexdigest()
+  written = []
+  for env in ('dev', 'prod'):
+    frozen = frozen_filename(filename, env)
+    f = open(frozen, 'wb')
+    try:
+      pickle.dump((digest, parse(source, dev=(env == 'dev'))), f, pickle.HIGHEST_PROTOCOL)
+    finally:
+      f.close()
+    written.append(frozen)
+  return written
+
+def config_get(key, filename='local.yaml'):
   """Return the value for the given key from the default config."""
-  return config()[key]
+  cached = __CONFIGS__.get(filename)
+  if cached is not None and not is_dev():
+    return cached[1][key]
+  return config(filename)[key]
+
+
+if __name__ == '__main__':
+  for frozen in freeze(*sys.argv[1:]):
+    print frozen
@@ -0,0 +1,91 @@
+import threading
+import time
+
+from collections import OrderedDict
+
+
+class LRUCache(object):
+  """A bounded, thread-safe least-recently-used cache.
+
+  Entries may expire after a time-to-live. Each entry has a size (1 by
+  default), and least recently used entries are evicted while the total
+  size exceeds max_size."""
+
+  def __init__(self, max_size=1000):
+    self.max_size = max_size
+    self.size = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key, default=None):
+    """Returns the value for key, or default if it is missing or expired."""
+    with self._lock:
+      entry = self._entries.pop(key, None)
+      if entry is None:
+        self.misses += 1
+        return default
+      value, expires, size = entry
+      if expires and expires <= time.time():
+        self.size -= size
+        self.misses += 1
+        return default
+      # most recently used
+      self._entries[key] = entry
+      self.hits += 1
+      return value
+
+  def set(self, key, value, ttl=0, size=1):
+    """Sets the value for key, to expire after ttl seconds if given."""
+    if size > self.max_size:
+      self.delete(key)
+      return
+    expires = ttl and time.time() + ttl
+    with self._lock:
+      entry = self._entries.pop(key, None)
+      if entry is not None:
+        self.size -= entry[2]
+      self._entries[key] = (value, expires, size)
+      self.size += size
+      while self.size > self.max_size:
+        _, entry = self._entries.popitem(last=False)
+        self.size -= entry[2]
+        self.evictions += 1
+
+  def delete(self, key):
+    """Removes the entry for key, if any."""
+    with self._lock:
+      entry = self._entries.pop(key, None)
+      if entry is not None:
+        self.size -= entry[2]
+
+  def delete_matching(self, predicate):
+    """Removes the entries whose values satisfy predicate."""
+    with self._lock:
+      for key, entry in self._entries.items():
+        if predicate(entry[0]):
+          del self._entries[key]
+          self.size -= entry[2]
+
+  def clear(self):
+    """Removes every entry."""
+    with self._lock:
+      self._entries.clear()
+      self.size = 0
+
+  def __len__(self):
+    return len(self._entries)
+
+  def __contains__(self, key):
+    return key in self._entries
+
+  def stats(self):
+    """Returns the hit, miss and eviction counters and the current size."""
+    return dict(
+      hits=self.hits,
+      misses=self.misses,
+      evictions=self.evictions,
+      entries=len(self._entries),
+      size=self.size)
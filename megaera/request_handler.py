@@ -1,19 +1,25 @@
+import calendar
+import hashlib
 import logging
 import os
 import re
 import sys
 import traceback
-import yaml
 import types
+import zlib
 
-from sanitize import sanitize
+from email.utils import formatdate, parsedate_tz, mktime_tz
+
+from sanitize import dump_json, dump_yaml
 from recursivedefaultdict import recursivedefaultdict
 import env
 import json
 import local
 from to_xml import to_xml
+from handler_cache import HandlerCache
+from timing import Timings, NULL_PHASE
 
-from google.appengine.api import users, memcache
+from google.appengine.api import users
 from google.appengine.api.datastore_errors import NeedIndexError
 import webapp2
 import jinja2
@@ -29,26 +35,255 @@ ERROR_HTML     = 'error.html'
 MIME_JSON = 'application/json'
 MIME_XML  = 'application/xml'
 MIME_ATOM = 'application/atom+xml'
+MIME_HTML = 'text/html'
+
+# output formats which can be asked for by query parameter or path suffix
+FORMATS = ('json', 'yaml', 'xml', 'atom')
+# output formats by MIME type, in order of preference when equally acceptable
+MIME_FORMATS = (
+  (MIME_HTML, 'html'),
+  ('application/xhtml+xml', 'html'),
+  (MIME_JSON, 'json'),
+  (MIME_XML, 'xml'),
+  (MIME_ATOM, 'atom'),
+)
+
+# optional jinja2 bytecode cache for production, e.g.
+# jinja2.MemcachedBytecodeCache(memcache)
+TEMPLATE_BYTECODE_CACHE = None
 
 __JINJA2_ENV__ = None
+__TEMPLATE_INDEX__ = None
 
 def set_jinja2_env(jinja2):
-  global __JINJA2_ENV__
+  global __JINJA2_ENV__, __TEMPLATE_INDEX__
   __JINJA2_ENV__ = jinja2
+  __TEMPLATE_INDEX__ = None
   return get_jinja2_env()
 
 def get_jinja2_env():
   global __JINJA2_ENV__
   if not __JINJA2_ENV__:
-    __JINJA2_ENV__ = jinja2.Environment(loader=jinja2.FileSystemLoader(TEMPLATES_BASE))
+    loader = jinja2.FileSystemLoader(TEMPLATES_BASE)
+    if env.is_dev():
+      # reload templates when they change
+      __JINJA2_ENV__ = jinja2.Environment(loader=loader)
+    else:
+      # compile every template once, never check for changes
+      __JINJA2_ENV__ = jinja2.Environment(
+        loader=loader,
+        auto_reload=False,
+        cache_size=-1,
+        bytecode_cache=TEMPLATE_BYTECODE_CACHE)
   return __JINJA2_ENV__
 
+def preload_templates(jinja2_env=None):
+  """Compiles every template and indexes their names.
+  
+  Once indexed, RequestHandler.template_exists() is a set lookup. Returns
+  None, leaving the index unset, if the loader cannot list its templates."""
+  global __TEMPLATE_INDEX__
+  if jinja2_env is None:
+    jinja2_env = get_jinja2_env()
+  try:
+    names = jinja2_env.list_templates()
+  except TypeError:
+    # e.g. a FunctionLoader, templates are looked up as files instead
+    return None
+  index = set()
+  for name in names:
+    try:
+      jinja2_env.get_template(name)
+    except jinja2.TemplateError, error:
+      # reported again when rendered
+      logging.error("Failed to compile template %s: %s", name, error)
+    index.add(name)
+  __TEMPLATE_INDEX__ = frozenset(index)
+  return __TEMPLATE_INDEX__
+
+TRAILING_SLASHES_RX = re.compile('^(/.*[^/])/+$')
+JSONP_CALLBACK_RX = re.compile('^[_a-z]([_a-z0-9])*$', re.IGNORECASE)
+# templates looked up for every page
+TEMPLATE_EXTENSIONS = ('html', 'atom')
+
+__ACCEPT_FORMATS__ = {}
+__ACCEPT_ENCODINGS__ = {}
+# content encodings in order of preference
+ENCODINGS = ('gzip', 'deflate')
+# content types worth compressing, others are e.g. already compressed images
+COMPRESSIBLE_RX = re.compile(r'^(text/|application/(json|xml|atom\+xml|javascript))')
+__PAGE_NAMES__ = {}
+
+def parse_accept(accept):
+  """Returns a dict of MIME types (or ranges) to qualities from an Accept header."""
+  ranges = {}
+  for part in accept.split(','):
+    params = part.split(';')
+    mime_type = params[0].strip().lower()
+    if not mime_type:
+      continue
+    q = 1.0
+    for param in params[1:]:
+      name, _, value = param.partition('=')
+      if name.strip().lower() == 'q':
+        try:
+          q = float(value)
+        except ValueError:
+          q = 0.0
+    ranges.setdefault(mime_type, q)
+  return ranges
+
+def accept_quality(ranges, mime_type):
+  """Returns the quality of a MIME type given the parsed Accept ranges."""
+  if mime_type in ranges:
+    return ranges[mime_type]
+  major = mime_type.split('/')[0] + '/*'
+  if major in ranges:
+    return ranges[major]
+  return ranges.get('*/*', 0.0)
+
+def accept_format(accept):
+  """Returns the best output format for an Accept header."""
+  try:
+    return __ACCEPT_FORMATS__[accept]
+  except KeyError:
+    ranges = parse_accept(accept)
+    best, best_q = 'html', 0.0
+    for mime_type, format in MIME_FORMATS:
+      q = accept_quality(ranges, mime_type)
+      if q > best_q:
+        best, best_q = format, q
+    if len(__ACCEPT_FORMATS__) >= 256:
+      __ACCEPT_FORMATS__.clear()
+    __ACCEPT_FORMATS__[accept] = best
+    return best
+
+def accept_encoding(accept):
+  """Returns the preferred content encoding for an Accept-Encoding header, or None."""
+  try:
+    return __ACCEPT_ENCODINGS__[accept]
+  except KeyError:
+    ranges = parse_accept(accept)
+    best = None
+    for encoding in ENCODINGS:
+      if ranges.get(encoding, ranges.get('*', 0.0)) > 0.0:
+        best = encoding
+        break
+    if len(__ACCEPT_ENCODINGS__) >= 256:
+      __ACCEPT_ENCODINGS__.clear()
+    __ACCEPT_ENCODINGS__[accept] = best
+    return best
+
+def compress(body, encoding, level=6):
+  """Returns body compressed with gzip or deflate."""
+  if encoding == 'gzip':
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush()
+  return zlib.compress(body, level)
+
+def make_etag(*parts):
+  """Returns a strong ETag for the given parts, e.g. a response body."""
+  return '"%s"' % hashlib.md5(':'.join([str(part) for part in parts])).hexdigest()
+
+def encoded_etag(etag, encoding):
+  """Returns the ETag of the encoded representation of a response."""
+  if etag and encoding:
+    return '%s-%s"' % (etag[:-1], encoding)
+  return etag
+
+def etag_matches(if_none_match, etag):
+  """Returns if an If-None-Match header matches the given ETag."""
+  for tag in if_none_match.split(','):
+    tag = tag.strip()
+    if tag.startswith('W/'):
+      tag = tag[2:]
+    if tag == etag or tag == '*':
+      return True
+  return False
+
+def http_timestamp(value):
+  """Returns the timestamp of a UTC datetime or an HTTP date, or a timestamp as it is."""
+  if value is None:
+    return None
+  if hasattr(value, 'utctimetuple'):
+    return calendar.timegm(value.utctimetuple())
+  if isinstance(value, basestring):
+    parsed = parsedate_tz(value)
+    return parsed and mktime_tz(parsed)
+  return int(value)
+
+def page_name(page):
+  """Returns the name of a page module, i.e., its path under HANDLERS_BASE."""
+  key = (HANDLERS_BASE, page.__file__)
+  try:
+    return __PAGE_NAMES__[key]
+  except KeyError:
+    match = re.search("%s/([^.]*)" % HANDLERS_BASE, page.__file__)
+    name = match and match.group(1)
+    __PAGE_NAMES__[key] = name
+    return name
+
+def page_metadata(page):
+  """Returns the attributes of a page's handler class, computed once per page."""
+  name = page_name(page)
+  if name:
+    templates = dict((ext, "%s.%s" % (name, ext)) for ext in TEMPLATE_EXTENSIONS)
+  else:
+    templates = {}
+  return dict(
+    page=page,
+    _page_name=name,
+    _page_templates=templates,
+    _page_has_get=hasattr(page, 'get'),
+    _page_has_post=hasattr(page, 'post'),
+  )
+
 class RequestHandler(webapp2.RequestHandler):
   
+  # the type of the response dictionary, e.g. responsedict
+  response_dict_class = recursivedefaultdict
+  # backs cache(), cached() and invalidate()
+  handler_cache = HandlerCache()
+  
+  _format = None
+  # set by output_cached() and cache_output()
+  _output_hit = False
+  _output_cache = None
+  # keys this request holds the handler cache lease for
+  _leases = ()
+  # ETag every 200 response to a GET request with the hash of its body
+  auto_etag = True
+  # set by not_modified()
+  _not_modified = False
+  # compress responses of at least compress_min_size bytes if the client accepts it,
+  # off since App Engine's front end compresses responses itself
+  compress = False
+  compress_min_size = 1024
+  compress_level = 6
+  # render templates with generate(), writing the output in chunks of stream_buffer_size
+  stream_templates = False
+  stream_buffer_size = 8192
+  # set by render() when it streamed a template
+  _streamed = False
+  # time the phases of requests, see timed()
+  timing = False
+  # report the timings in a Server-Timing header and in the log
+  timing_header = True
+  timing_log = True
+  # callables taking the handler and its Timings, e.g. to feed metrics
+  timing_hooks = ()
+  _timings = None
+  
+  # set by with_page()
+  _page_name = None
+  _page_templates = {}
+  _page_has_get = False
+  _page_has_post = False
+  
   @classmethod
   def with_page(cls, page):
     if isinstance(page, types.ModuleType):
-      return type(page.__file__, (cls,), dict(page=page))
+      return type(page.__file__, (cls,), page_metadata(page))
     if isinstance(page, str):
       try:
         __import__(page)
@@ -63,7 +298,7 @@ class RequestHandler(webapp2.RequestHandler):
   def response_dict(self, **kwargs):
     """Returns the response dictionary and sets the given values."""
     if not hasattr(self, '__response_dict__'):
-      setattr(self, '__response_dict__', recursivedefaultdict())
+      setattr(self, '__response_dict__', self.response_dict_class())
     if kwargs:
       self.__response_dict__.update(**kwargs)
     return self.__response_dict__
@@ -76,17 +311,28 @@ class RequestHandler(webapp2.RequestHandler):
     """Returns the URL arg at the given index or None."""
     return self.url_args()[index]
   
+  def read_json(self, items=False):
+    """Reads the JSON request body incrementally.
+    
+    Returns the parsed body, or with items=True an iterator over the
+    elements of a top-level array which are read as they arrive."""
+    values = json.iterload(self.request.body_file, items=items)
+    if items:
+      return values
+    for value in values:
+      return value
+  
   def get(self, *args):
     """Responds to GET requests from WSGIApplication."""
     if self.has_param('post'):
       return self.post(*args)
     # check for trailing slashes
-    match = re.compile('^(/.*[^/])/+$').search(self.request.path)
+    match = TRAILING_SLASHES_RX.search(self.request.path)
     if match and match.groups(1):
       # strip trailing slashes and redirect
       return self.redirect(match.group(1))
     # check if we can respond
-    if hasattr(self.page, 'get'):
+    if self._page_has_get:
       # run the handler and get the template path
       path = self.handle(self.page.get, *args)
     else:
@@ -99,12 +345,13 @@ class RequestHandler(webapp2.RequestHandler):
     else:
       # for html
       self.render(path)
+    self.finish()
   
   def post(self, *args):
     """Responds to POST requests from WSGIApplication"""
     self.__url_args__ = args
     # check if we can post
-    if hasattr(self.page, 'post'):
+    if self._page_has_post:
       # run the handler and get the template path
       path = self.handle(self.page.post, *args)
     else:
@@ -119,6 +366,105 @@ class RequestHandler(webapp2.RequestHandler):
     else:
       # otherwise render the template
       self.render(path)
+      self.finish()
+  
+  def dispatch(self):
+    """Dispatches the request, then releases any leases still held."""
+    if self.timing:
+      # the total covers the whole dispatch
+      self._timings = Timings()
+    try:
+      return super(RequestHandler, self).dispatch()
+    finally:
+      self.release_leases()
+      if self._timings is not None:
+        self.report_timings()
+  
+  def finish(self):
+    """Runs after the response has been rendered."""
+    if self.response.status_int == 200 and 'Content-Encoding' not in self.response.headers:
+      conditional = self.request.method in ('GET', 'HEAD')
+      etag = self.response.headers.get('ETag')
+      encoding = None
+      encoded = {}
+      # a streamed body is not joined into one string to hash or compress it
+      if not self._streamed:
+        body = self.response.body
+        if conditional and self.auto_etag and not etag:
+          with self.timed('etag'):
+            etag = make_etag(body)
+        encoding = self.content_encoding(body)
+        if encoding:
+          with self.timed('compress'):
+            encoded[encoding] = compress(body, encoding, self.compress_level)
+      if self._output_cache:
+        key, group, time, stale_time = self._output_cache
+        with self.timed('cache'):
+          self.handler_cache.set(key, dict(
+            body=self.response.body,
+            content_type=self.response.headers.get('Content-Type'),
+            status=self.response.status_int,
+            etag=etag,
+            # compressed once, served as is by later hits
+            encoded=encoded,
+          ), ttl=time, group=group, stale_time=stale_time)
+      etag = encoded_etag(etag, encoding)
+      if etag:
+        self.response.headers['ETag'] = etag
+      if conditional and self.is_fresh(etag):
+        self.respond_not_modified()
+      elif encoding:
+        self.respond_encoded(encoded[encoding], encoding)
+    self.release_leases()
+    if self._timings is not None:
+      self.report_timings()
+  
+  def timed(self, phase):
+    """Returns a context manager which times the given phase of the request, if timing.
+    
+      with handler.timed('datastore'):
+        ...
+    """
+    if not self.timing:
+      return NULL_PHASE
+    if self._timings is None:
+      self._timings = Timings()
+    return self._timings.phase(phase)
+  
+  def report_timings(self):
+    """Reports the timings of the request, once."""
+    timings = self._timings
+    self._timings = None
+    if self.timing_header:
+      self.response.headers['Server-Timing'] = timings.server_timing()
+    if self.timing_log:
+      logging.info("timings %s %s", self.request.path, timings)
+    for hook in self.timing_hooks:
+      hook(self, timings)
+  
+  def content_encoding(self, body):
+    """Returns the encoding to compress the response body with, or None."""
+    if not self.compress or len(body) < self.compress_min_size:
+      return None
+    if not COMPRESSIBLE_RX.match(self.response.headers.get('Content-Type') or MIME_HTML):
+      return None
+    # the response depends on the request's Accept-Encoding
+    self.add_vary('Accept-Encoding')
+    accept = self.request.headers.get('Accept-Encoding')
+    return accept and accept_encoding(accept)
+  
+  def add_vary(self, header):
+    """Adds a request header the response depends on to its Vary header."""
+    vary = self.response.headers.get('Vary')
+    if not vary:
+      self.response.headers['Vary'] = header
+    elif header.lower() not in [name.strip().lower() for name in vary.split(',')]:
+      self.response.headers['Vary'] = '%s, %s' % (vary, header)
+  
+  def respond_encoded(self, body, encoding):
+    """Responds with the given compressed body."""
+    self.response.body = body
+    self.response.headers['Content-Encoding'] = encoding
   
   def has_errors(self):
     """Returns if the response dictionary contains form errors."""
@@ -135,27 +481,53 @@ class RequestHandler(webapp2.RequestHandler):
     """Returns true if this requests accepts the given MIME type"""
     accept = self.request.headers.get('Accept')
     if accept:
-      return accept == mime_type
+      return accept_quality(parse_accept(accept), mime_type) > 0
+  
+  @property
+  def format(self):
+    """The output format of the current request: json, yaml, xml, atom or html."""
+    if self._format is None:
+      self._format = self.negotiate_format()
+    return self._format
+  
+  def negotiate_format(self):
+    """Returns the output format from the query parameters, the path suffix, or the Accept header."""
+    names = set(self.request.params)
+    for format in FORMATS:
+      if format in names:
+        return format
+    path = self.request.path
+    dot = path.rfind('.')
+    if dot > path.rfind('/'):
+      suffix = path[dot+1:]
+      if suffix in FORMATS:
+        return suffix
+    # the response depends on the request's Accept, even without one
+    self.add_vary('Accept')
+    accept = self.request.headers.get('Accept')
+    if accept:
+      return accept_format(accept)
+    return 'html'
   
   def is_json(self):
     """Returns if the current request is for JSON."""
-    return self.has_param('json') or self.request.path.endswith('.json') or self.accepts(MIME_JSON)
+    return self.format == 'json'
   
   def is_yaml(self):
     """Returns if the current request is for YAML."""
-    return self.has_param('yaml') or self.request.path.endswith('.yaml')
+    return self.format == 'yaml'
   
   def is_xml(self):
     """Returns if the current request is for XML."""
-    return self.has_param('xml') or self.request.path.endswith('.xml') or self.accepts(MIME_XML)
+    return self.format == 'xml'
   
   def is_atom(self):
     """Returns if the current request is for Atom."""
-    return self.has_param('atom') or self.request.path.endswith('.atom') or self.accepts(MIME_ATOM)
+    return self.format == 'atom'
   
   def is_html(self):
     """Returns if the current request is for HTML."""
-    return not self.is_json() and not self.is_yaml() and not self.is_xml() and not self.is_atom()
+    return self.format == 'html'
   
   def logout_url(self):
     """Returns the logout URL of the current request."""
@@ -170,57 +542,227 @@ class RequestHandler(webapp2.RequestHandler):
     return self.environ('HTTP_HOST')
   
   def cache_key(self, page=None, vary=None):
-    page_name = self.page_name(page=page)
-    return '-'.join([str(x) for x in (page_name, vary) if x])
+    return '-'.join([str(x) for x in (self.page_name(page=page), vary) if x])
   
   def cached(self, vary=None):
     """Returns if the current page is cached and updates the response dict with the cached values."""
     if self.has_param('no_cache'):
       return
-    cached = memcache.get(
-      key=self.cache_key(vary=vary),
-      namespace="handler-cache")
+    cached = self.cache_lookup(self.cache_key(vary=vary))
     if cached:
       # update the response
       self.response_dict(**cached)
       return True
   
-  def cache(self, time=0, vary=None, **kwargs):
-    """Caches and updates the response dict with the given values for the current page."""
-    memcache.set(
-      key=self.cache_key(vary=vary),
-      value=kwargs,
-      time=time,
-      namespace="handler-cache")
+  def cache(self, time=0, vary=None, stale_time=0, **kwargs):
+    """Caches and updates the response dict with the given values for the current page.
+    
+    Once expired, the values are still served for stale_time seconds
+    while one request recomputes them."""
+    key = self.cache_key(vary=vary)
+    with self.timed('cache'):
+      self.handler_cache.set(key, kwargs, ttl=time, stale_time=stale_time)
+    self.release_lease(key)
     # update the response
     self.response_dict(**kwargs)
   
+  def cached_many(self, varies):
+    """Returns the set of the given varies which are cached for the current page
+    and updates the response dict with their cached values.
+    
+    The values are looked up with a single memcache round trip."""
+    if self.has_param('no_cache'):
+      return set()
+    keys = dict((self.cache_key(vary=vary), vary) for vary in varies)
+    found = set()
+    for key, cached in self.cache_lookup_many(keys.keys()).iteritems():
+      if cached:
+        # update the response
+        self.response_dict(**cached)
+        found.add(keys[key])
+    return found
+  
+  def cache_many(self, values, time=0, stale_time=0):
+    """Caches and updates the response dict with the values for each vary
+    of the current page, given as a dict of vary to values."""
+    keys = dict((self.cache_key(vary=vary), kwargs) for vary, kwargs in values.iteritems())
+    with self.timed('cache'):
+      self.handler_cache.set_many(keys, ttl=time, stale_time=stale_time)
+    self.release_leases(keys)
+    # update the response
+    for kwargs in values.itervalues():
+      self.response_dict(**kwargs)
+  
+  def cache_lookup(self, key, group=None):
+    """Returns the value cached for key, letting one request at a time recompute it.
+    
+    Returns None when this request should recompute the value, i.e., it
+    holds the lease on key. Other requests are served the stale value, if
+    any, or wait for the new one."""
+    return self.cache_lookup_many([key], {key: group})[key]
+  
+  def cache_lookup_many(self, keys, groups=None):
+    """Returns a dict of the value cached for each key, as cache_lookup()."""
+    with self.timed('cache'):
+      return self._cache_lookup_many(keys, groups)
+  
+  def _cache_lookup_many(self, keys, groups):
+    results = {}
+    stale = {}
+    for key, (value, fresh) in self.handler_cache.lookup_many(keys, groups).iteritems():
+      if fresh:
+        results[key] = value
+      else:
+        stale[key] = value
+    if not stale:
+      return results
+    # this request already recomputes the keys it holds the lease for
+    leased = set(key for key in stale if key in self._leases)
+    leased.update(self.handler_cache.lease_many([key for key in stale if key not in leased]))
+    if leased:
+      if not self._leases:
+        self._leases = set()
+      self._leases.update(leased)
+    groups = groups or {}
+    for key, value in stale.iteritems():
+      if key in leased:
+        results[key] = None
+      elif value is not None:
+        # stale while revalidating
+        results[key] = value
+      else:
+        results[key] = self.handler_cache.wait(key, groups.get(key))
+    return results
+  
+  def release_lease(self, key):
+    """Releases the lease on key, if this request holds it."""
+    self.release_leases([key])
+  
+  def release_leases(self, keys=None):
+    """Releases the leases on keys, or every lease, this request holds."""
+    if keys is None:
+      keys = list(self._leases)
+    else:
+      keys = [key for key in keys if key in self._leases]
+    if keys:
+      self._leases.difference_update(keys)
+      self.handler_cache.release_many(keys)
+  
+  def output_cache_key(self, vary=None):
+    """Returns the key of the rendered output for the current page, format and JSONP callback."""
+    parts = ['output', self.cache_key(vary=vary), self.format]
+    if self.is_json():
+      callback = self.jsonp_callback()
+      if callback:
+        parts.append(callback)
+    return ':'.join(parts)
+  
+  def output_cached(self, vary=None):
+    """Returns if the rendered output of the current page is cached and responds with it.
+    
+    Call this first thing in the handler and return if it is true, the
+    response will not be rendered again."""
+    if self.has_param('no_cache'):
+      return
+    cached = self.cache_lookup(self.output_cache_key(vary=vary), group=self.cache_key(vary=vary))
+    if cached:
+      self._output_hit = True
+      if cached['content_type']:
+        self.response.headers['Content-Type'] = cached['content_type']
+      encoding = self.content_encoding(cached['body'])
+      etag = encoded_etag(cached.get('etag'), encoding)
+      if etag:
+        self.response.headers['ETag'] = etag
+        if self.is_fresh(etag):
+          self.respond_not_modified()
+          return True
+      self.set_status(cached['status'])
+      if encoding:
+        encoded = cached.get('encoded') or {}
+        body = encoded.get(encoding) or compress(cached['body'], encoding, self.compress_level)
+        self.respond_encoded(body, encoding)
+      else:
+        self.response.out.write(cached['body'])
+      return True
+  
+  def cache_output(self, time=0, vary=None, stale_time=0):
+    """Caches the rendered output of the current page once it has been rendered."""
+    self._output_cache = (self.output_cache_key(vary=vary), self.cache_key(vary=vary), time, stale_time)
+  
+  def not_modified(self, version=None, last_modified=None, vary=None):
+    """Returns if the client's copy of the current page is current and responds with 304.
+    
+    The ETag is derived from version, any value which changes along with
+    the page, the output format and vary. last_modified is a UTC datetime
+    or a timestamp. Call this first thing in the handler and return if it
+    is true, the response will not be rendered."""
+    etag = None
+    if version is not None:
+      etag = make_etag(self.output_cache_key(vary=vary), version)
+      if self.compress:
+        # the client may hold the compressed representation
+        accept = self.request.headers.get('Accept-Encoding')
+        encoded = encoded_etag(etag, accept and accept_encoding(accept))
+        if encoded != etag and self.is_fresh(encoded):
+          etag = encoded
+      self.response.headers['ETag'] = etag
+    last_modified = http_timestamp(last_modified)
+    if last_modified is not None:
+      self.response.headers['Last-Modified'] = formatdate(last_modified, usegmt=True)
+    if self.is_fresh(etag, last_modified):
+      self.respond_not_modified()
+      return True
+  
+  def is_fresh(self, etag=None, last_modified=None):
+    """Returns if the request's conditional headers match the given ETag or modification time."""
+    if self.request.method not in ('GET', 'HEAD'):
+      return False
+    if_none_match = self.request.headers.get('If-None-Match')
+    if if_none_match:
+      return etag is not None and etag_matches(if_none_match, etag)
+    if last_modified is not None:
+      since = http_timestamp(self.request.headers.get('If-Modified-Since'))
+      return since is not None and last_modified <= since
+    return False
+  
+  def respond_not_modified(self):
+    """Responds with 304 and an empty body."""
+    self.response.set_status(304)
+    self.response.clear()
+    self._not_modified = True
+  
   def invalidate(self, page=None, vary=None):
     """Invalidates the cache for given page or the current page."""
-    memcache.delete(
-      key=self.cache_key(vary=vary, page=page),
-      namespace="handler-cache")
+    self.handler_cache.delete(self.cache_key(vary=vary, page=page))
+  
+  def invalidate_many(self, pages_or_varies):
+    """Invalidates the cache for each of the given pages, or varies of the current page."""
+    self.handler_cache.delete_many([
+      self.cache_key(page=item) if isinstance(item, types.ModuleType) else self.cache_key(vary=item)
+      for item in pages_or_varies])
   
   def page_name(self, page=None):
     """Returns the name of the given page or the current page."""
-    if not page:
-      page = self.page
-    match = re.compile("%s/([^.]*)" % HANDLERS_BASE).search(page.__file__)
-    if match:
-      return match.group(1)
+    if not page or page is self.page:
+      return self._page_name
+    return page_name(page)
   
   def default_template(self, ext="html"):
     """Returns the path for the current page's default template."""
+    template = self._page_templates.get(ext)
+    if template:
+      return template
     name = self.page_name()
     if name:
       return "%s.%s" % (name, ext)
-    raise Exception("failed to build default template for %s" % page)
+    raise Exception("failed to build default template for %s" % self.page)
   
   def handle(self, method, *args):
     """Invokes the given method and return the template path to render."""
     self.__url_args__ = args
     try:
-      return method(self, self.response_dict())
+      with self.timed('handler'):
+        return method(self, self.response_dict())
     except NotFoundException:
       return self.not_found()
     except NeedIndexError:
@@ -247,33 +789,40 @@ class RequestHandler(webapp2.RequestHandler):
       url += self.extension()
     return url
   
+  def jsonp_callback(self):
+    """Returns the valid JSONP callback of the current request, if any."""
+    callback = self.request.get('callback')
+    if JSONP_CALLBACK_RX.match(callback):
+      return callback
+  
   def render(self, path, base="html"):
     """Renders the given template or the default template, or JSON(P)/YAML."""
+    if self._output_hit or self._not_modified:
+      # already responded from the output cache or with 304
+      return
     if self.is_json():
-      sanitized = sanitize(self.response_dict(), self.urlize)
-      json_str = json.write(sanitized)
-      callback = self.request.get('callback')
-      if re.match("^[_a-z]([_a-z0-9])*$", callback, re.IGNORECASE):
-        json_str = "%s(%s)" % (callback, json_str) # jsonp
+      callback = self.jsonp_callback()
       self.response.headers['Content-Type'] = "%s; charset=UTF-8" % MIME_JSON
-      self.response.out.write(json_str)
+      if callback:
+        self.response.out.write("%s(" % callback)
+      with self.timed('json'):
+        dump_json(self.response_dict(), self.urlize, self.response.out)
+      if callback:
+        self.response.out.write(")")
       return
     if self.is_yaml():
-      sanitized = sanitize(self.response_dict(), self.urlize)
-      yaml_str = yaml.safe_dump(sanitized, default_flow_style=False)
       self.response.headers['Content-Type'] = "text/plain; charset=UTF-8"
-      self.response.out.write(yaml_str)
+      with self.timed('yaml'):
+        dump_yaml(self.response_dict(), self.urlize, self.response.out, default_flow_style=False)
       return
     if self.is_xml():
-      sanitized = sanitize(self.response_dict(), self.urlize)
-      xml_str = to_xml(value=sanitized, root="response")
       self.response.headers['Content-Type'] = "%s; charset=UTF-8" % MIME_XML
-      self.response.out.write(xml_str)
+      with self.timed('xml'):
+        to_xml(value=self.response_dict(), root="response", urlize=self.urlize, out=self.response.out)
       return
     if not path:
       path = self.default_template(ext=base)
-    full_path = os.path.join(TEMPLATES_BASE, path)
-    if self.file_exists(full_path):
+    if self.template_exists(path):
       try:
         # the template might find these handy
         self.response_dict(
@@ -281,12 +830,19 @@ class RequestHandler(webapp2.RequestHandler):
           is_dev=env.is_dev()
         )
         template = get_jinja2_env().get_template(path)
-        rendered = template.render(**self.response_dict())
         if self.is_atom() and self.get_status() == 200:
           # for atom
           self.response.headers['Content-Type'] = "%s; charset=UTF-8" % MIME_ATOM
-        self.response.out.write(rendered)
+        with self.timed('template'):
+          if self.stream_templates:
+            self._streamed = True
+            self.write_chunks(template.generate(**self.response_dict()))
+          else:
+            self.response.out.write(template.render(**self.response_dict()))
       except jinja2.TemplateError, error:
+        # drop what was streamed so far
+        self.response.clear()
+        self._streamed = False
         self.response.headers['Content-Type'] = 'text/plain'
         message = "Template syntax error: %s" % error
         logging.critical(message)
@@ -303,6 +859,34 @@ class RequestHandler(webapp2.RequestHandler):
       logging.critical("Template not found: %s" % path)
       self.render(self.not_found())
   
+  def write_chunks(self, chunks):
+    """Writes chunks of output as they are produced, in batches of stream_buffer_size."""
+    out = self.response.out
+    limit = self.stream_buffer_size
+    buffered = []
+    size = 0
+    for chunk in chunks:
+      buffered.append(chunk)
+      size += len(chunk)
+      if size >= limit:
+        out.write(u''.join(buffered))
+        del buffered[:]
+        size = 0
+    if buffered:
+      out.write(u''.join(buffered))
+  
+  def template_exists(self, path):
+    """Returns if the given template exists, using the preloaded index if any.
+    
+    In production, templates are preloaded on first use, once the app has
+    added its filters and globals to the jinja2 environment."""
+    index = __TEMPLATE_INDEX__
+    if index is None and not env.is_dev():
+      index = preload_templates()
+    if index is not None:
+      return path in index
+    return self.file_exists(os.path.join(TEMPLATES_BASE, path))
+  
   def file_exists(self, path):
     return os.path.exists(path)
   
@@ -0,0 +1,76 @@
+class responsedict(dict):
+  """A dict whose keys can be read/written by the dot operator.
+
+  Like recursivedefaultdict, reading a missing key returns an empty
+  responsedict, but that child is only stored in its parent once
+  something is written to it. Reading response.messages in a template
+  leaves no empty branch behind."""
+  __slots__ = ('_parent', '_key', '_pending')
+
+  def __init__(self, *args, **kwargs):
+    super(responsedict, self).__init__(*args, **kwargs)
+    object.__setattr__(self, '_parent', None)
+    object.__setattr__(self, '_key', None)
+    # detached children by key, so that every read returns the same one
+    object.__setattr__(self, '_pending', None)
+
+  @classmethod
+  def _child(cls, parent, key):
+    """Returns a detached child of parent for the given key."""
+    child = cls()
+    object.__setattr__(child, '_parent', parent)
+    object.__setattr__(child, '_key', key)
+    return child
+
+  def _attach(self):
+    """Stores this child in its parent, and so on up."""
+    parent = self._parent
+    if parent is not None:
+      object.__setattr__(self, '_parent', None)
+      # unless it has been replaced meanwhile
+      if parent._pending and parent._pending.get(self._key) is self and self._key not in parent:
+        parent[self._key] = self
+
+  def __missing__(self, key):
+    pending = self._pending
+    if pending is None:
+      pending = {}
+      object.__setattr__(self, '_pending', pending)
+    child = pending.get(key)
+    if child is None:
+      child = pending[key] = self._child(self, key)
+    return child
+
+  def __getattr__(self, name):
+    if name.startswith('__'):
+      raise AttributeError(name)
+    return self[name]
+
+  def __setattr__(self, name, value):
+    self[name] = value
+
+  def __delattr__(self, name):
+    try:
+      del self[name]
+    except KeyError:
+      raise AttributeError(name)
+
+  def __setitem__(self, key, value):
+    super(responsedict, self).__setitem__(key, value)
+    if self._pending:
+      # replaces any detached child
+      self._pending.pop(key, None)
+    self._attach()
+
+  def update(self, *args, **kwargs):
+    super(responsedict, self).update(*args, **kwargs)
+    if self:
+      self._attach()
+
+  def setdefault(self, key, default=None):
+    value = super(responsedict, self).setdefault(key, default)
+    self._attach()
+    return value
+
+  def __reduce__(self):
+    return (type(self), (dict(self),))
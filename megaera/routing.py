@@ -0,0 +1,134 @@
+"""Routing requests to the pages under HANDLERS_BASE
+
+build_routes() scans HANDLERS_BASE for page modules and returns a
+single route for all of them. Pages are imported on their first request
+rather than when the app starts, and requests are routed with one dict
+lookup of their path rather than by trying a regex per page.
+
+A page's path is its module's path under HANDLERS_BASE, "default"
+modules being their directory's index. For example,
+
+  handlers/default.py       /
+  handlers/something.py     /something
+  handlers/foo/default.py   /foo
+
+As with RequestHandler.path_with_page(), the path may be suffixed by an
+output format, e.g. /something.json.
+"""
+
+import logging
+import os
+import re
+import sys
+import threading
+
+import webapp2
+
+import request_handler
+from request_handler import RequestHandler, FORMATS, page_metadata
+
+
+FORMAT_SUFFIX_RX = re.compile(r'^(.*?)\.?(%s)?$' % '|'.join(FORMATS))
+INDEX_MODULE = 'default'
+
+
+def page_modules(base=None):
+  """Returns the names of the page modules under base, or HANDLERS_BASE."""
+  base = base or request_handler.HANDLERS_BASE
+  modules = []
+  for directory, directories, files in os.walk(base):
+    if '__init__.py' not in files:
+      # not a package
+      del directories[:]
+      continue
+    directories.sort()
+    package = os.path.normpath(directory).replace(os.sep, '.')
+    for filename in sorted(files):
+      name, ext = os.path.splitext(filename)
+      if ext == '.py' and name != '__init__':
+        modules.append('%s.%s' % (package, name))
+  return modules
+
+def module_page_name(module_name, base=None):
+  """Returns the name of a page module from its name, i.e., its path under base, without importing it."""
+  base = (base or request_handler.HANDLERS_BASE).replace(os.sep, '.')
+  if module_name.startswith(base + '.'):
+    return module_name[len(base) + 1:].replace('.', '/')
+
+def page_path(module_name, base=None):
+  """Returns the path of a page module."""
+  parts = module_page_name(module_name, base).split('/')
+  if parts[-1] == INDEX_MODULE:
+    parts.pop()
+  return '/' + '/'.join(parts)
+
+
+class LazyPage(object):
+  """Mixin for handler classes which import their page on its first request."""
+  
+  # the name of the page module, until it is imported
+  _page_module = None
+  _page_lock = threading.Lock()
+  
+  def initialize(self, request, response):
+    cls = type(self)
+    if cls._page_module is not None:
+      cls.load_page()
+    super(LazyPage, self).initialize(request, response)
+  
+  @classmethod
+  def load_page(cls):
+    """Imports the page module and sets its metadata on this class."""
+    with cls._page_lock:
+      module_name = cls._page_module
+      if module_name is None:
+        # loaded by another thread
+        return
+      try:
+        __import__(module_name)
+      except ImportError:
+        logging.error("missing handler for %s", module_name)
+        raise
+      for name, value in page_metadata(sys.modules[module_name]).iteritems():
+        setattr(cls, name, value)
+      cls._page_module = None
+
+def lazy_handler(module_name, cls=RequestHandler, base=None):
+  """Returns a handler class for a page module which is imported on its first request."""
+  return type(module_name, (LazyPage, cls), dict(
+    _page_module=module_name,
+    _page_name=module_page_name(module_name, base),
+  ))
+
+
+class PageTable(webapp2.BaseRoute):
+  """Routes requests to pages by looking up their path, less any format suffix.
+  
+  pages is a list of (path, handler class) pairs."""
+  
+  def __init__(self, pages=()):
+    super(PageTable, self).__init__(None)
+    self.routes = {}
+    for path, handler in pages:
+      self.add(path, handler)
+  
+  def add(self, path, handler):
+    self.routes[path] = webapp2.SimpleRoute(path, handler)
+  
+  def match(self, request):
+    path = request.path
+    route = self.routes.get(path)
+    if route is not None:
+      return route, (None,), {}
+    match = FORMAT_SUFFIX_RX.match(path)
+    if match.group(2):
+      route = self.routes.get(match.group(1) or '/')
+      if route is not None:
+        # the format is passed to the handler, as by path_with_page()
+        return route, (match.group(2),), {}
+
+def build_routes(base=None, cls=RequestHandler):
+  """Returns a route for every page module under base, or HANDLERS_BASE."""
+  return PageTable([
+    (page_path(module_name, base), lazy_handler(module_name, cls, base))
+    for module_name in page_modules(base)])
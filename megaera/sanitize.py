@@ -1,16 +1,199 @@
+import types
+
+import yaml
+
+import json
+from recursivedefaultdict import recursivedefaultdict
+from responsedict import responsedict
+
 from google.appengine.api import datastore_types
 
 
-def sanitize(obj, urlize):
-  """Sanitize for json or yaml output."""
-  if isinstance(obj, dict):
-    # a dictionary
-    return dict([(key, sanitize(value, urlize)) for key, value in obj.iteritems()])
+# how values of a type are sanitized
+DICT, SEQUENCE, LAZY, SANITIZE, STRING = range(5)
+
+__ACTIONS__ = {}
+
+def action(ty, obj=None):
+  """Returns how values of the given type are sanitized.
+  
+  Old-style instances all share one type, so they are checked one by one."""
+  if ty is types.InstanceType:
+    return instance_action(obj)
+  try:
+    return __ACTIONS__[ty]
+  except KeyError:
+    if issubclass(ty, dict):
+      # a dictionary
+      act = DICT
+    elif issubclass(ty, (list, tuple)):
+      # a sequence
+      act = SEQUENCE
+    elif hasattr(ty, '__iter__'):
+      # any other iterable, e.g. generators and queries
+      act = LAZY
+    elif hasattr(ty, 'sanitize'):
+      # a sanitizeable object
+      act = SANITIZE
+    else:
+      # default: stringify
+      act = STRING
+    __ACTIONS__[ty] = act
+    return act
+
+def instance_action(obj):
+  """Returns how an old-style instance is sanitized."""
   if hasattr(obj, '__iter__'):
-    # a iterable sequence
-    return [sanitize(v, urlize) for v in obj]
+    return LAZY
   if hasattr(obj, 'sanitize'):
-    # a sanitizeable object
-    return obj.sanitize(urlize)
-  # default: stringify
-  return str(obj)
+    return SANITIZE
+  return STRING
+
+# response dicts create empty children when they are read
+__PHANTOMS__ = (recursivedefaultdict, responsedict)
+
+def phantom(value):
+  """Returns if value is an empty branch left behind by reading a response dict."""
+  if type(value) not in __PHANTOMS__:
+    return False
+  for child in value.itervalues():
+    if not phantom(child):
+      return False
+  return True
+
+class LazySequence(object):
+  """An iterable whose items are sanitized as it is iterated."""
+  __slots__ = ('iterable', 'urlize')
+
+  def __init__(self, iterable, urlize):
+    self.iterable = iterable
+    self.urlize = urlize
+
+  def __iter__(self):
+    urlize = self.urlize
+    for value in self.iterable:
+      yield sanitize(value, urlize, lazy=True)
+
+def sanitize(obj, urlize, lazy=False):
+  """Sanitize for json or yaml output.
+
+  If lazy, iterables other than lists and tuples (e.g. generators and
+  queries) are not consumed here but returned as a LazySequence, which
+  only the megaera serializers know how to write."""
+  result = [None]
+  stack = [(obj, result, 0)]
+  pop = stack.pop
+  push = stack.append
+  while stack:
+    obj, parent, key = pop()
+    ty = type(obj)
+    act = __ACTIONS__.get(ty)
+    if act is None:
+      act = action(ty, obj)
+    if act is LAZY:
+      if lazy:
+        parent[key] = LazySequence(obj, urlize)
+        continue
+      obj = list(obj)
+      act = SEQUENCE
+    if act is DICT:
+      value = {}
+      for item in obj.iteritems():
+        if not phantom(item[1]):
+          push((item[1], value, item[0]))
+    elif act is SEQUENCE:
+      value = [None] * len(obj)
+      for index, item in enumerate(obj):
+        push((item, value, index))
+    elif act is SANITIZE:
+      value = obj.sanitize(urlize)
+    else:
+      value = str(obj)
+    parent[key] = value
+  return result[0]
+
+
+class JsonSanitizer(json.JsonStreamWriter):
+  """Writes JSON, sanitizing values as they are visited."""
+  
+  def __init__(self, urlize, escaped_forward_slash=False):
+    super(JsonSanitizer, self).__init__(escaped_forward_slash)
+    self.urlize = urlize
+    # writes keys and the output of sanitize() hooks as they are
+    self._raw = json.JsonStreamWriter(escaped_forward_slash)
+    self._raw._parts = self._parts
+  
+  def _write(self, obj):
+    ty = type(obj)
+    act = __ACTIONS__.get(ty)
+    if act is None:
+      act = action(ty, obj)
+    if act is DICT:
+      self._writeSanitizedDict(obj)
+    elif act is SEQUENCE or act is LAZY:
+      self._writeSequence(obj)
+    elif act is SANITIZE:
+      self._raw._write(obj.sanitize(self.urlize))
+    else:
+      self._writeString(str(obj))
+  
+  def _writeSanitizedDict(self, obj):
+    parts = self._parts
+    raw = self._raw._write
+    write = self._write
+    parts.append("{")
+    first = True
+    for k, v in obj.iteritems():
+      if phantom(v):
+        continue
+      if first:
+        first = False
+      else:
+        parts.append(",")
+      raw(k)
+      parts.append(":")
+      write(v)
+      if self._out is not None and len(parts) >= self.chunk_parts:
+        self._flush()
+    parts.append("}")
+
+class YamlSanitizer(yaml.SafeDumper):
+  """Dumps YAML, sanitizing values as they are represented."""
+  
+  urlize = None
+  _raw = False
+  
+  def represent_data(self, data):
+    if self._raw:
+      return yaml.SafeDumper.represent_data(self, data)
+    ty = type(data)
+    act = __ACTIONS__.get(ty)
+    if act is None:
+      act = action(ty, data)
+    if act is DICT:
+      if any(phantom(value) for value in data.itervalues()):
+        data = dict((key, value) for key, value in data.iteritems() if not phantom(value))
+      return self.represent_dict(data)
+    if act is SEQUENCE or act is LAZY:
+      return self.represent_list(data)
+    if act is SANITIZE:
+      # the output of sanitize() hooks is dumped as it is
+      self._raw = True
+      try:
+        return yaml.SafeDumper.represent_data(self, data.sanitize(self.urlize))
+      finally:
+        self._raw = False
+    return self.represent_str(str(data))
+  
+  def ignore_aliases(self, data):
+    # sanitized values are copies, they are never aliased
+    return True
+
+def dump_json(obj, urlize, out=None, escaped_forward_slash=False):
+  """Sanitizes and writes JSON in one pass, to out if given."""
+  return JsonSanitizer(urlize, escaped_forward_slash).write(obj, out)
+
+def dump_yaml(obj, urlize, stream=None, **kwargs):
+  """Sanitizes and dumps YAML in one pass, to stream if given."""
+  dumper = type('YamlSanitizer', (YamlSanitizer,), dict(urlize=staticmethod(urlize)))
+  return yaml.dump(obj, stream, Dumper=dumper, **kwargs)
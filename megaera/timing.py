@@ -0,0 +1,79 @@
+"""Timing the phases of a request
+
+Timings accumulates the duration and count of named phases, e.g. the
+handler, rendering and the cache. Phases may nest, e.g. the cache is
+used by the handler.
+"""
+
+import time
+
+
+class Timings(object):
+  """The durations and counts of the phases of a request, in the order they start."""
+  
+  def __init__(self):
+    self.start = time.time()
+    self.order = []
+    self.durations = {}
+    self.counts = {}
+  
+  def phase(self, name):
+    """Returns a context manager which times the given phase."""
+    if name not in self.durations:
+      self.order.append(name)
+      self.durations[name] = 0.0
+      self.counts[name] = 0
+    return Phase(self, name)
+  
+  def add(self, name, elapsed):
+    self.durations[name] += elapsed
+    self.counts[name] += 1
+  
+  def items(self):
+    """Returns a list of (phase, seconds, count) triples, and the total."""
+    items = [(name, self.durations[name], self.counts[name]) for name in self.order]
+    items.append(('total', time.time() - self.start, 1))
+    return items
+  
+  def server_timing(self):
+    """Returns the timings as a Server-Timing header."""
+    metrics = []
+    for name, elapsed, count in self.items():
+      metric = '%s;dur=%.1f' % (name, elapsed * 1000)
+      if count > 1:
+        metric += ';desc="%d"' % count
+      metrics.append(metric)
+    return ', '.join(metrics)
+  
+  def __str__(self):
+    return ' '.join('%s=%.1fms/%d' % item for item in
+      [(name, elapsed * 1000, count) for name, elapsed, count in self.items()])
+
+
+class Phase(object):
+  __slots__ = ('timings', 'name', 'start')
+  
+  def __init__(self, timings, name):
+    self.timings = timings
+    self.name = name
+  
+  def __enter__(self):
+    self.start = time.time()
+    return self
+  
+  def __exit__(self, *exc_info):
+    self.timings.add(self.name, time.time() - self.start)
+    return False
+
+
+class NullPhase(object):
+  """Times nothing, used when timing is disabled."""
+  __slots__ = ()
+  
+  def __enter__(self):
+    return self
+  
+  def __exit__(self, *exc_info):
+    return False
+
+NULL_PHASE = NullPhase()
@@ -1,39 +1,135 @@
-from xml.dom.minidom import Document
+from sanitize import action, phantom, SANITIZE, STRING
 
 
-def to_xml(value, root='data', indent='  '):
-  """Returns XML from dicts or seqs."""
-  doc = Document()
+def to_xml(value, root='data', indent='  ', urlize=None, out=None, pretty=True):
+  """Returns XML from dicts or seqs, or writes it to out if given.
+
+  If urlize is given, values are sanitized as they are added."""
+  writer = XmlWriter(out=out, indent=indent, pretty=pretty)
+  writer.declaration()
+  value, urlize = sanitized(value, urlize)
   if hasattr(value, '__iter__') and not isinstance(value, dict):
     # special case for top-level sequence
-    parent = doc.createElement(root)
-    doc.appendChild(parent)
-    add(doc, parent, 'value', value)
+    writer.start(root)
+    add(writer, 'value', value, urlize)
+    writer.end(root)
   else:
-    add(doc, doc, root, value)
-  return doc.toprettyxml(indent=indent)
+    add(writer, root, value, urlize)
+  return writer.close()
+
+def sanitized(value, urlize):
+  """Sanitizes value if urlize is given, returns the value and the urlize for its children."""
+  if urlize:
+    act = action(type(value), value)
+    if act is SANITIZE:
+      # the output of sanitize() hooks is added as it is
+      return value.sanitize(urlize), None
+    if act is STRING:
+      return str(value), urlize
+  return value, urlize
 
-def add(doc, parent, key, value):
-  """Adds value to document under parent as key."""
+def add(writer, key, value, urlize=None):
+  """Writes value as key."""
   if isinstance(value, dict):
-    child = doc.createElement(key)
-    parent.appendChild(child)
-    for item in value.iteritems():
-      add(doc, child, *item)
+    writer.start(key)
+    for item_key, item in value.iteritems():
+      if urlize and phantom(item):
+        continue
+      item, item_urlize = sanitized(item, urlize)
+      add(writer, item_key, item, item_urlize)
+    writer.end(key)
   elif hasattr(value, '__iter__'):
     for item in value:
+      item, item_urlize = sanitized(item, urlize)
       if hasattr(item, '__iter__') and not isinstance(item, dict):
-        child = doc.createElement('value')
-        parent.appendChild(child)
-        add(doc, child, 'value', item)
+        writer.start('value')
+        add(writer, 'value', item, item_urlize)
+        writer.end('value')
       else:
-        add(doc, parent, key, item)
+        add(writer, key, item, item_urlize)
   else:
     # default: text node
     if isinstance(value, unicode):
       text = value.encode('utf8')
     else:
       text = str(value)
-    child = doc.createElement(key)
-    child.appendChild(doc.createTextNode(text))
-    parent.appendChild(child)
+    writer.start(key)
+    writer.text(text)
+    writer.end(key)
+
+def escape(text):
+  """Escapes text for element content."""
+  if '&' in text:
+    text = text.replace('&', '&amp;')
+  if '<' in text:
+    text = text.replace('<', '&lt;')
+  if '"' in text:
+    text = text.replace('"', '&quot;')
+  if '>' in text:
+    text = text.replace('>', '&gt;')
+  return text
+
+class XmlWriter(object):
+  """Writes escaped XML as it is emitted.
+
+  In pretty mode every element and text node is on its own indented line,
+  in compact mode there is no whitespace between nodes. Output is either
+  returned by close() or flushed in chunks to a file-like object."""
+
+  chunk_parts = 1024
+
+  def __init__(self, out=None, indent='  ', pretty=True):
+    self.out = out
+    if pretty:
+      self.indent = indent
+      self.newl = '\n'
+    else:
+      self.indent = ''
+      self.newl = ''
+    self.parts = []
+    self.depth = 0
+    # whether the last start tag is still open, i.e., has no children yet
+    self.pending = False
+
+  def declaration(self):
+    self.parts.append('<?xml version="1.0" ?>' + self.newl)
+
+  def start(self, tag):
+    if isinstance(tag, unicode):
+      tag = tag.encode('utf8')
+    self._open()
+    self.parts.append(self.indent * self.depth + '<' + tag)
+    self.pending = True
+    self.depth += 1
+
+  def end(self, tag):
+    if isinstance(tag, unicode):
+      tag = tag.encode('utf8')
+    self.depth -= 1
+    if self.pending:
+      self.parts.append('/>' + self.newl)
+      self.pending = False
+    else:
+      self.parts.append('%s</%s>%s' % (self.indent * self.depth, tag, self.newl))
+    if self.out is not None and len(self.parts) >= self.chunk_parts:
+      self.flush()
+
+  def text(self, text):
+    self._open()
+    self.parts.append(self.indent * self.depth + escape(text) + self.newl)
+
+  def _open(self):
+    if self.pending:
+      self.parts.append('>' + self.newl)
+      self.pending = False
+
+  def flush(self):
+    if self.parts:
+      self.out.write(''.join(self.parts))
+      del self.parts[:]
+
+  def close(self):
+    """Returns the XML, or flushes it to out if given."""
+    if self.out is None:
+      return ''.join(self.parts)
+    self.flush()
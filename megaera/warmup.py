@@ -0,0 +1,74 @@
+"""Warming up an instance before it serves requests
+
+App Engine sends /_ah/warmup to new instances when the warmup inbound
+service is enabled. warmup() does what the first requests would
+otherwise pay for: importing the pages, compiling the templates and
+parsing the local config.
+"""
+
+import logging
+import os
+import time
+
+import webapp2
+
+import env
+import local
+import request_handler
+import routing
+
+
+def warmup(routes=None):
+  """Imports every page, compiles every template and loads the local config.
+  
+  routes are those of the app, by default every page under HANDLERS_BASE
+  is imported. Returns a list of (phase, seconds) pairs."""
+  timings = []
+  for phase, function in (
+      ('handlers', lambda: import_pages(routes)),
+      ('templates', compile_templates),
+      ('config', local.config)):
+    start = time.time()
+    function()
+    elapsed = time.time() - start
+    logging.info("warmup %s: %.1f ms", phase, elapsed * 1000)
+    timings.append((phase, elapsed))
+  return timings
+
+def import_pages(routes=None):
+  """Imports the pages of lazily loaded routes, or every page under HANDLERS_BASE."""
+  if routes is None:
+    if os.path.isdir(request_handler.HANDLERS_BASE):
+      for module_name in routing.page_modules():
+        __import__(module_name)
+    return
+  for route in routes:
+    if isinstance(route, routing.PageTable):
+      handlers = [page_route.handler for page_route in route.routes.itervalues()]
+    else:
+      handlers = [route.handler]
+    for handler in handlers:
+      if isinstance(handler, type) and issubclass(handler, routing.LazyPage):
+        try:
+          handler.load_page()
+        except ImportError:
+          # logged, and reported again by its first request
+          pass
+
+def compile_templates():
+  """Builds the jinja2 environment and, in production, compiles every template."""
+  jinja2_env = request_handler.get_jinja2_env()
+  if not env.is_dev() and request_handler.__TEMPLATE_INDEX__ is None:
+    request_handler.preload_templates(jinja2_env)
+
+
+class WarmupHandler(webapp2.RequestHandler):
+  """Responds to /_ah/warmup by warming up the app's routes."""
+  
+  def get(self):
+    timings = warmup(self.app.router.match_routes)
+    self.response.headers['Content-Type'] = 'text/plain'
+    for phase, elapsed in timings:
+      self.response.out.write("%s: %.1f ms\n" % (phase, elapsed * 1000))
+
+WARMUP_ROUTE = ('/_ah/warmup', WarmupHandler)
@@ -2,6 +2,14 @@ import unittest
 
 from test.megaera_test import *
 from test.to_xml_test import *
+from test.json_test import *
+from test.sanitize_test import *
+from test.responsedict_test import *
+from test.handler_cache_test import *
+from test.local_test import *
+from test.fetch_test import *
+from test.routing_test import *
+from test.warmup_test import *
 
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,232 @@
+import unittest
+
+from google.appengine.api import memcache
+
+from megaera import fetch
+
+from test.megaera_test import stub_memcache
+
+
+class StubResponse(object):
+  def __init__(self, content, content_type='text/plain', status_code=200, **headers):
+    self.content = content
+    # urlfetch headers are case insensitive
+    self.headers = {'content-type': content_type}
+    self.headers.update((key.replace('_', '-'), value) for key, value in headers.items())
+    self.status_code = status_code
+
+
+class StubRpc(object):
+  def __init__(self, urlfetch, deadline):
+    self.urlfetch = urlfetch
+    self.deadline = deadline
+  
+  def get_result(self):
+    self.urlfetch.log.append(('get_result', self.url))
+    result = self.urlfetch.responses[self.url]
+    if isinstance(result, Exception):
+      raise result
+    return result
+
+
+class StubUrlfetch(object):
+  class Error(Exception): pass
+  class DownloadError(Error): pass
+  class InvalidURLError(Error): pass
+  
+  def __init__(self, responses):
+    self.responses = responses
+    self.log = []
+  
+  def create_rpc(self, deadline=None):
+    return StubRpc(self, deadline)
+  
+  def fetch(self, url, headers={}, deadline=None):
+    self.log.append(('fetch', url, headers))
+    response = self.responses[url]
+    if callable(response):
+      return response(headers)
+    return response
+  
+  def make_fetch_call(self, rpc, url):
+    if not url.startswith('http'):
+      raise self.InvalidURLError(url)
+    self.log.append(('make_fetch_call', url))
+    rpc.url = url
+
+
+class TestFetch(unittest.TestCase):
+  def setUp(self):
+    self.urlfetch = fetch.urlfetch
+    fetch.urlfetch = StubUrlfetch({
+      'http://a/': StubResponse('caf\xc3\xa9'),
+      'http://b/%20': StubResponse('caf\xe9', 'text/plain; charset=latin-1'),
+      'http://c/': StubUrlfetch.DownloadError('timeout'),
+      'http://d/': StubResponse('caf\xc3\xa9', 'text/plain; charset=bogus'),
+      'http://e/': StubResponse('caf\xe9'),
+    })
+  
+  def tearDown(self):
+    fetch.urlfetch = self.urlfetch
+  
+  def test_fetch_many(self):
+    results = fetch.fetch_many(['http://a/', 'http://b/ ', 'http://c/', 'invalid'])
+    self.assertEquals([result.url for result in results],
+      ['http://a/', 'http://b/ ', 'http://c/', 'invalid'])
+    self.assertEquals([result.content for result in results], [u'caf\xe9', u'caf\xe9', None, None])
+    self.assertEquals([result.ok for result in results], [True, True, False, False])
+    self.assertTrue(isinstance(results[2].error, StubUrlfetch.DownloadError))
+    self.assertTrue(isinstance(results[3].error, StubUrlfetch.InvalidURLError))
+  
+  def test_decode_errors_per_url(self):
+    results = fetch.fetch_many(['http://d/', 'http://a/'])
+    self.assertTrue(isinstance(results[0].error, LookupError))
+    self.assertEquals(results[0].response.content, 'caf\xc3\xa9')
+    self.assertEquals(results[1].content, u'caf\xe9')
+    results = fetch.fetch_many(['http://e/', 'http://a/'], errors='strict')
+    self.assertTrue(isinstance(results[0].error, UnicodeDecodeError))
+    self.assertEquals([result.ok for result in results], [False, True])
+  
+  def test_fetches_are_concurrent(self):
+    batch = fetch.fetch_many_async(['http://a/', 'http://b/ '], deadline=5)
+    self.assertEquals(fetch.urlfetch.log,
+      [('make_fetch_call', 'http://a/'), ('make_fetch_call', 'http://b/%20')])
+    self.assertEquals([rpc.deadline for url, rpc, error in batch.fetches], [5, 5])
+    batch.get_results()
+    self.assertEquals(fetch.urlfetch.log[2:],
+      [('get_result', 'http://a/'), ('get_result', 'http://b/%20')])
+
+  def test_sniff_charset(self):
+    self.assertEquals(fetch.sniff_charset(StubResponse('\xef\xbb\xbfcaf\xc3\xa9')), 'utf-8-sig')
+    self.assertEquals(fetch.sniff_charset(StubResponse('\xff\xfec\x00')), 'utf-16')
+    self.assertEquals(fetch.sniff_charset(StubResponse('', 'text/xml; charset=ISO-8859-1')), 'iso8859-1')
+    self.assertEquals(fetch.sniff_charset(
+      StubResponse('<?xml version="1.0" encoding="latin-1"?>', 'text/xml')), 'iso8859-1')
+    self.assertEquals(fetch.sniff_charset(
+      StubResponse('<html><meta charset="windows-1252">', 'text/html')), 'cp1252')
+    self.assertEquals(fetch.sniff_charset(StubResponse('', 'text/plain; charset=bogus')), 'utf-8')
+  
+  def test_iterdecode(self):
+    response = StubResponse('caf\xc3\xa9' * 3)
+    chunks = list(fetch.iterdecode(response, chunk_size=4))
+    self.assertTrue(len(chunks) > 1)
+    self.assertEquals(u''.join(chunks), u'caf\xe9' * 3)
+  
+  def test_decode_errors(self):
+    response = StubResponse('caf\xe9')
+    self.assertEquals(fetch.decode_response(response), 'caf\xe9')
+    self.assertEquals(fetch.decode_response(response, errors='replace'), u'caf\ufffd')
+    self.assertEquals(fetch.decode_response(response, errors='ignore'), u'caf')
+    self.assertRaises(UnicodeDecodeError, fetch.decode_response, response, errors='strict')
+    self.assertEquals(fetch.decode_response(response, 'latin-1', errors='strict'), u'caf\xe9')
+
+
+class TestFetchCache(unittest.TestCase):
+  def setUp(self):
+    stub_memcache()
+    memcache.flush_all()
+    self.urlfetch = fetch.urlfetch
+    self.etag = '"v1"'
+    def etagged(headers):
+      if headers.get('If-None-Match') == self.etag:
+        return StubResponse('', status_code=304, cache_control='max-age=60')
+      return StubResponse('v1', etag=self.etag)
+    fetch.urlfetch = StubUrlfetch({
+      'http://fresh/': StubResponse('fresh', cache_control='max-age=60'),
+      'http://expires/': StubResponse('expires',
+        date='Mon, 01 Jan 2024 00:00:00 GMT', expires='Mon, 01 Jan 2024 00:01:00 GMT'),
+      'http://no-store/': StubResponse('no-store', cache_control='no-store', etag='"v1"'),
+      'http://etag/': etagged,
+      'http://error/': StubResponse('error', status_code=500, cache_control='max-age=60'),
+    })
+  
+  def tearDown(self):
+    fetch.urlfetch = self.urlfetch
+  
+  def fetches(self, url):
+    return len([entry for entry in fetch.urlfetch.log if entry[:2] == ('fetch', url)])
+  
+  def test_freshness(self):
+    self.assertEquals(fetch.freshness({'cache-control': 'public, max-age=60'}), 60)
+    self.assertEquals(fetch.freshness({'cache-control': 'max-age=60, no-cache'}), 0)
+    self.assertEquals(fetch.freshness({'cache-control': 'private, max-age=60'}), None)
+    self.assertEquals(fetch.freshness({'expires': 'Mon, 01 Jan 2024 00:01:00 GMT',
+      'date': 'Mon, 01 Jan 2024 00:00:00 GMT'}), 60)
+    self.assertEquals(fetch.freshness({'expires': '0'}), 0)
+    self.assertEquals(fetch.freshness({}), 0)
+  
+  def test_fresh(self):
+    cache = fetch.FetchCache(memcache_tier=False)
+    self.assertEquals(cache.fetch('http://fresh/').content, 'fresh')
+    self.assertEquals(cache.fetch('http://fresh/').content, 'fresh')
+    self.assertEquals(cache.fetch('http://expires/').content, 'expires')
+    self.assertEquals(cache.fetch('http://expires/').content, 'expires')
+    self.assertEquals(self.fetches('http://fresh/'), 1)
+    self.assertEquals(self.fetches('http://expires/'), 1)
+    self.assertEquals(cache.stats()['hit_ratio'], 0.5)
+  
+  def test_not_cached(self):
+    cache = fetch.FetchCache(memcache_tier=False)
+    cache.fetch('http://no-store/')
+    self.assertEquals(cache.fetch('http://error/').status_code, 500)
+    cache.fetch('http://no-store/')
+    cache.fetch('http://error/')
+    self.assertEquals(self.fetches('http://no-store/'), 2)
+    self.assertEquals(self.fetches('http://error/'), 2)
+    self.assertEquals(cache.stats()['misses'], 4)
+  
+  def test_revalidate(self):
+    cache = fetch.FetchCache(memcache_tier=False)
+    self.assertEquals(cache.fetch('http://etag/').content, 'v1')
+    self.assertEquals(cache.fetch('http://etag/').content, 'v1')
+    self.assertEquals(fetch.urlfetch.log[-1], ('fetch', 'http://etag/', {'If-None-Match': '"v1"'}))
+    self.assertEquals(cache.stats()['revalidations'], 1)
+    # fresh for 60 seconds after the 304
+    cache.fetch('http://etag/')
+    self.assertEquals(self.fetches('http://etag/'), 2)
+    self.assertEquals(cache.stats()['hits'], 1)
+  
+  def test_changed(self):
+    cache = fetch.FetchCache(memcache_tier=False)
+    cache.fetch('http://etag/')
+    self.etag = '"v2"'
+    self.assertEquals(cache.fetch('http://etag/').content, 'v1')
+    self.assertEquals(cache.stats()['misses'], 2)
+  
+  def test_memcache_tier(self):
+    fetch.FetchCache().fetch('http://fresh/')
+    cache = fetch.FetchCache()
+    self.assertEquals(cache.fetch('http://fresh/').content, 'fresh')
+    self.assertEquals(self.fetches('http://fresh/'), 1)
+  
+  def test_fetch_decode(self):
+    cache = fetch.fetch_cache
+    fetch.fetch_cache = fetch.FetchCache(memcache_tier=False)
+    try:
+      self.assertEquals(fetch.fetch_decode('http://fresh/', cached=True), u'fresh')
+      self.assertEquals(fetch.fetch_decode('http://fresh/', cached=True), u'fresh')
+      fetch.fetch_decode('http://fresh/')
+    finally:
+      fetch.fetch_cache = cache
+    self.assertEquals(self.fetches('http://fresh/'), 2)
+  
+  def test_copies(self):
+    cache = fetch.FetchCache(memcache_tier=False)
+    r1 = cache.fetch('http://fresh/')
+    r2 = cache.fetch('http://fresh/')
+    self.assertTrue(r1 is not r2)
+    r1.headers['Cache-Control'] = 'no-store'
+    self.assertEquals(r2.headers['Cache-Control'], 'max-age=60')
+    self.assertTrue('CACHE-CONTROL' in r2.headers)
+  
+  def test_memcache_size(self):
+    fetch.urlfetch.responses['http://large/'] = StubResponse(
+      'x' * fetch.MEMCACHE_MAX_SIZE, cache_control='max-age=60')
+    fetch.FetchCache().fetch('http://large/')
+    self.assertEquals(memcache.get('http://large/', namespace='fetch-cache'), None)
+    fetch.FetchCache().fetch('http://fresh/')
+    self.assertEquals(len(memcache.get('http://fresh/', namespace='fetch-cache')), 5)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,143 @@
+import threading
+import time
+import unittest
+
+from megaera.lru import LRUCache
+from megaera.handler_cache import HandlerCache
+
+from google.appengine.api import memcache
+
+from test.megaera_test import stub_memcache
+
+
+class TestLRUCache(unittest.TestCase):
+  def test_get_set(self):
+    cache = LRUCache()
+    self.assertEquals(cache.get('foo'), None)
+    cache.set('foo', 'bar')
+    self.assertEquals(cache.get('foo'), 'bar')
+    self.assertEquals(cache.stats()['hits'], 1)
+    self.assertEquals(cache.stats()['misses'], 1)
+
+  def test_evicts_least_recently_used(self):
+    cache = LRUCache(max_size=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    self.assertEquals(cache.get('b'), None)
+    self.assertEquals(cache.get('a'), 1)
+    self.assertEquals(cache.get('c'), 3)
+    self.assertEquals(cache.evictions, 1)
+
+  def test_evicts_by_size(self):
+    cache = LRUCache(max_size=10)
+    cache.set('a', 'a', size=4)
+    cache.set('b', 'b', size=4)
+    cache.set('c', 'c', size=4)
+    self.assertEquals(len(cache), 2)
+    self.assertEquals(cache.size, 8)
+    cache.set('d', 'd', size=11)
+    self.assertFalse('d' in cache)
+
+  def test_ttl(self):
+    cache = LRUCache()
+    cache.set('foo', 'bar', ttl=0.01)
+    time.sleep(0.02)
+    self.assertEquals(cache.get('foo'), None)
+
+
+class TestHandlerCache(unittest.TestCase):
+  def setUp(self):
+    stub_memcache()
+
+  def test_get_set(self):
+    cache = HandlerCache()
+    self.assertEquals(cache.get('test-get-set'), None)
+    cache.set('test-get-set', dict(foo='bar'))
+    self.assertEquals(cache.get('test-get-set'), dict(foo='bar'))
+
+  def test_local_tier(self):
+    cache = HandlerCache(check_interval=60)
+    cache.set('test-local', dict(foo='bar'))
+    memcache.delete('test-local', namespace='handler-cache')
+    self.assertEquals(cache.get('test-local'), dict(foo='bar'))
+    self.assertEquals(cache.stats()['local']['hits'], 1)
+
+  def test_memcache_tier(self):
+    HandlerCache().set('test-memcache', dict(foo='bar'))
+    cache = HandlerCache()
+    self.assertEquals(cache.get('test-memcache'), dict(foo='bar'))
+    self.assertEquals(cache.stats()['memcache']['hits'], 1)
+    self.assertTrue('test-memcache' in cache.local)
+
+  def test_values_are_copies(self):
+    cache = HandlerCache()
+    cache.set('test-copies', dict(foo=['bar']))
+    cache.get('test-copies')['foo'].append('baz')
+    self.assertEquals(cache.get('test-copies'), dict(foo=['bar']))
+
+  def test_invalidated_by_other_instance(self):
+    this, other = HandlerCache(), HandlerCache(check_interval=0)
+    this.set('test-other', dict(foo='bar'))
+    self.assertEquals(other.get('test-other'), dict(foo='bar'))
+    this.delete('test-other')
+    self.assertEquals(other.get('test-other'), None)
+    self.assertEquals(this.get('test-other'), None)
+
+  def test_many(self):
+    cache = HandlerCache()
+    cache.set_many(dict(a=1, b=2), groups=dict(a='group', b='group'))
+    self.assertEquals(HandlerCache().lookup_many(['a', 'b', 'c'], dict(a='group', b='group')),
+      dict(a=(1, True), b=(2, True), c=(None, False)))
+    cache.delete_many(['group'])
+    self.assertEquals(cache.lookup_many(['a', 'b'], dict(a='group', b='group')),
+      dict(a=(None, False), b=(None, False)))
+
+  def test_lease_many(self):
+    cache = HandlerCache()
+    self.assertTrue(cache.lease('test-lease-b'))
+    self.assertEquals(cache.lease_many(['test-lease-a', 'test-lease-b']), set(['test-lease-a']))
+    cache.release_many(['test-lease-a', 'test-lease-b'])
+    self.assertTrue(cache.lease('test-lease-b'))
+    cache.release('test-lease-b')
+
+  def test_lease(self):
+    this, other = HandlerCache(), HandlerCache()
+    self.assertTrue(this.lease('test-lease'))
+    self.assertFalse(this.lease('test-lease'))
+    self.assertFalse(other.lease('test-lease'))
+    this.release('test-lease')
+    self.assertTrue(other.lease('test-lease'))
+    other.release('test-lease')
+
+  def test_stale(self):
+    cache = HandlerCache()
+    cache.set('test-stale', dict(foo='bar'), ttl=0.01, stale_time=60)
+    time.sleep(0.02)
+    self.assertEquals(cache.get('test-stale'), None)
+    self.assertEquals(cache.lookup('test-stale'), (dict(foo='bar'), False))
+
+  def test_wait(self):
+    cache = HandlerCache()
+    self.assertTrue(cache.lease('test-wait'))
+    values = []
+    waiter = threading.Thread(target=lambda: values.append(cache.wait('test-wait')))
+    waiter.start()
+    cache.set('test-wait', dict(foo='bar'))
+    cache.release('test-wait')
+    waiter.join(1)
+    self.assertEquals(values, [dict(foo='bar')])
+
+  def test_wait_for_other_instance(self):
+    this, other = HandlerCache(), HandlerCache(wait_timeout=1)
+    self.assertTrue(this.lease('test-wait-other'))
+    self.assertFalse(other.lease('test-wait-other'))
+    timer = threading.Timer(0.05, this.set, ('test-wait-other', dict(foo='bar')))
+    timer.start()
+    self.assertEquals(other.wait('test-wait-other'), dict(foo='bar'))
+    this.release('test-wait-other')
+
+
+if __name__ == '__main__':
+  unittest.main()
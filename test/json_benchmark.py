@@ -0,0 +1,33 @@
+"""Compares JsonReader and JsonScanner on large documents.
+
+    megaera$ python test/json_benchmark.py
+"""
+
+import timeit
+
+from megaera import json
+
+
+def document(entries):
+  return json.write([
+    dict(
+      id=n,
+      title="entry %d with \"quotes\" and a\nnewline" % n,
+      score=n * 0.5,
+      tags=['alpha', 'beta', 'gamma'],
+      draft=(n % 2 == 0),
+      parent=None,
+      body="lorem ipsum dolor sit amet " * 40,
+    ) for n in range(entries)])
+
+def main():
+  for entries in (100, 1000, 4000):
+    doc = document(entries)
+    assert json.JsonReader().read(doc) == json.JsonScanner().read(doc)
+    reader = min(timeit.repeat(lambda: json.JsonReader().read(doc), number=1, repeat=3))
+    scanner = min(timeit.repeat(lambda: json.JsonScanner().read(doc), number=1, repeat=3))
+    print "%6d entries, %8d bytes: JsonReader %.4fs, JsonScanner %.4fs (%.1fx)" % (
+      entries, len(doc), reader, scanner, reader / scanner)
+
+if __name__ == '__main__':
+  main()
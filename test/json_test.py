@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+
+import unittest
+from StringIO import StringIO
+
+from megaera import json
+
+
+SAMPLES = [
+  None,
+  True,
+  False,
+  0,
+  -42,
+  10L**20,
+  1.5,
+  '',
+  'foo',
+  'a "quoted" \\ back/slash\b\f\n\r\t',
+  u'bar’baz',
+  [],
+  (),
+  {},
+  [1, 'two', [3.0, None], {'four': (True, False)}],
+  {'foo': {'bar': ['baz', {'qux': 'a/b'}]}},
+]
+
+
+class TestJsonWriter(unittest.TestCase):
+  def test_same_as_json_writer(self):
+    for sample in SAMPLES:
+      self.assertEquals(
+        json.write(sample),
+        json.JsonWriter().write(sample))
+
+  def test_escaped_forward_slash(self):
+    for sample in SAMPLES:
+      self.assertEquals(
+        json.write(sample, escaped_forward_slash=True),
+        json.JsonWriter().write(sample, escaped_forward_slash=True))
+    self.assertEquals(json.write('a/b', escaped_forward_slash=True), r'"a\/b"')
+    self.assertEquals(json.write('a/b'), '"a/b"')
+
+  def test_dump(self):
+    out = StringIO()
+    json.dump(SAMPLES, out)
+    self.assertEquals(out.getvalue(), json.write(SAMPLES))
+
+  def test_dump_chunks(self):
+    chunks = []
+    class Out(object):
+      def write(self, chunk):
+        chunks.append(chunk)
+    writer = json.JsonStreamWriter()
+    writer.chunk_parts = 8
+    value = [dict(foo=n) for n in range(100)]
+    writer.write(value, Out())
+    self.assertTrue(len(chunks) > 1)
+    self.assertEquals("".join(chunks), json.write(value))
+
+  def test_cannot_write(self):
+    self.assertRaises(json.WriteException, json.write, object())
+
+
+class TestJsonScanner(unittest.TestCase):
+  def test_same_as_json_reader(self):
+    for sample in SAMPLES:
+      doc = json.write(sample)
+      self.assertEquals(json.read(doc), json.JsonReader().read(doc))
+
+  def test_whitespace_and_comments(self):
+    doc = ' /* a */ {"foo" : [ 1 , 2.5 ] , // b\n "bar": "baz" } '
+    self.assertEquals(json.read(doc), dict(foo=[1, 2.5], bar='baz'))
+
+  def test_escapes(self):
+    self.assertEquals(json.read(r'"a\"b\\c\/d\n\u2019"'), u'a"b\\c/d\n\u2019')
+
+  def test_exponent(self):
+    self.assertEquals(json.read('-1.5e3'), -1500.0)
+
+  def test_error_position(self):
+    try:
+      json.read('{"foo": [1,\n 2 3]}')
+      self.fail()
+    except json.ReadException, error:
+      self.assertEquals(error.position, 15)
+      self.assertEquals(error.line, 2)
+      self.assertEquals(error.column, 4)
+
+  def test_invalid(self):
+    for doc in ('', '[1,', '{"foo" 1}', '"foo', 'tru', '{1: 2}', '"\\x"'):
+      self.assertRaises(json.ReadException, json.read, doc)
+
+
+class TestJsonPushParser(unittest.TestCase):
+  def feed(self, doc, size, items=False):
+    parser = json.JsonPushParser(items=items)
+    values = []
+    for i in range(0, len(doc), size):
+      values.extend(parser.feed(doc[i:i+size]))
+    values.extend(parser.close())
+    return values
+
+  def test_chunks(self):
+    doc = ' {"foo": [1, 22, 3.5e1], "bar": "b\\"az"} '
+    for size in range(1, len(doc)):
+      self.assertEquals(self.feed(doc, size), [json.read(doc)])
+
+  def test_items(self):
+    doc = '[1, "two" , {"three": [3]}, 4.5, null] '
+    for size in range(1, len(doc)):
+      self.assertEquals(self.feed(doc, size, items=True), json.read(doc))
+
+  def test_items_as_soon_as_read(self):
+    parser = json.JsonPushParser(items=True)
+    self.assertEquals(parser.feed('[{"a": 1}, {"b"'), [dict(a=1)])
+    self.assertEquals(parser.feed(': 2}]'), [dict(b=2)])
+    self.assertEquals(parser.close(), [])
+
+  def test_long_item(self):
+    doc = '[%s, 1]' % json.write(range(20000))
+    parser = json.JsonPushParser(items=True)
+    parse = parser._parse
+    parses = []
+    def counting_parse(results):
+      parses.append(parser._state)
+      return parse(results)
+    parser._parse = counting_parse
+    values = []
+    for i in range(0, len(doc), 64):
+      values.extend(parser.feed(doc[i:i+64]))
+    values.extend(parser.close())
+    self.assertEquals(values, [range(20000), 1])
+    # re-scanned once the input has doubled, not on every chunk
+    self.assertTrue(parses.count('item') < 20)
+
+  def test_items_not_array(self):
+    self.assertEquals(self.feed('{"a": 1}', 3, items=True), [dict(a=1)])
+
+  def test_incomplete(self):
+    parser = json.JsonPushParser(items=True)
+    parser.feed('[1, 2')
+    self.assertRaises(json.ReadException, parser.close)
+
+  def test_error_position(self):
+    try:
+      self.feed('[1,\n 2 3]', 2, items=True)
+      self.fail()
+    except json.ReadException, error:
+      self.assertEquals(error.position, 7)
+      self.assertEquals(error.line, 2)
+      self.assertEquals(error.column, 4)
+
+  def test_iterload(self):
+    doc = json.write(range(1000))
+    self.assertEquals(list(json.iterload(StringIO(doc), items=True, chunk_size=64)), range(1000))
+    self.assertEquals(list(json.iterload(StringIO(doc), chunk_size=64)), [range(1000)])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,83 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from megaera import local
+
+
+class TestLocal(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.filename = os.path.join(self.dir, 'local.yaml')
+    self.server_software = os.environ.pop('SERVER_SOFTWARE', None)
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+    local.__CONFIGS__.clear()
+    if self.server_software is not None:
+      os.environ['SERVER_SOFTWARE'] = self.server_software
+    else:
+      os.environ.pop('SERVER_SOFTWARE', None)
+
+  def write(self, text, mtime):
+    f = open(self.filename, 'w')
+    f.write(text)
+    f.close()
+    os.utime(self.filename, (mtime, mtime))
+
+  def test_branch(self):
+    self.write('pirate: ninja\nrobot:\n  dev: zombie\n  prod: monkey\n', 1000)
+    self.assertEquals(local.config(self.filename), dict(pirate='ninja', robot='zombie'))
+    self.assertEquals(local.config_get('robot', self.filename), 'zombie')
+    self.assertRaises(KeyError, local.config_get, 'ninja', self.filename)
+
+  def test_missing(self):
+    self.assertEquals(local.config(self.filename), dict())
+
+  def test_memoized(self):
+    self.write('pirate: ninja\n', 1000)
+    self.assertTrue(local.config(self.filename) is local.config(self.filename))
+
+  def test_reloaded_in_development(self):
+    self.write('pirate: ninja\n', 1000)
+    self.assertEquals(local.config_get('pirate', self.filename), 'ninja')
+    self.write('pirate: zombie\n', 2000)
+    self.assertEquals(local.config_get('pirate', self.filename), 'zombie')
+
+  def test_not_reloaded_in_production(self):
+    os.environ['SERVER_SOFTWARE'] = 'Google App Engine/1.9.0'
+    self.write('robot:\n  dev: zombie\n  prod: monkey\n', 1000)
+    self.assertEquals(local.config_get('robot', self.filename), 'monkey')
+    self.write('robot: ninja\n', 2000)
+    self.assertEquals(local.config_get('robot', self.filename), 'monkey')
+
+  def test_freeze(self):
+    self.write('robot:\n  dev: zombie\n  prod: monkey\n', 1000)
+    frozen = local.freeze(self.filename)
+    self.assertEquals(frozen, [self.filename + '.dev.pickle', self.filename + '.prod.pickle'])
+    source = open(self.filename).read()
+    self.assertEquals(local.load_frozen(self.filename, source), dict(robot='zombie'))
+    os.environ['SERVER_SOFTWARE'] = 'Google App Engine/1.9.0'
+    self.assertEquals(local.load_frozen(self.filename, source), dict(robot='monkey'))
+
+  def test_frozen_is_loaded(self):
+    self.write('pirate: ninja\n', 1000)
+    local.freeze(self.filename)
+    self.write('pirate: ninja\n', 2000)
+    parse = local.parse
+    local.parse = None
+    try:
+      self.assertEquals(local.config(self.filename), dict(pirate='ninja'))
+    finally:
+      local.parse = parse
+
+  def test_stale_frozen_is_ignored(self):
+    self.write('pirate: ninja\n', 1000)
+    local.freeze(self.filename)
+    self.write('pirate: zombie\n', 2000)
+    self.assertEquals(local.config(self.filename), dict(pirate='zombie'))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,11 +1,19 @@
+import datetime
+import os
 import unittest
 import types
+import zlib
+
+import webapp2
 
 import megaera
 from megaera import RequestHandler, set_jinja2_env
+from megaera.responsedict import responsedict
+from megaera.handler_cache import HandlerCache
 
 from google.appengine.ext.webapp import Request, Response
 from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
 from google.appengine.api.memcache import memcache_stub
 
 class MockJinja:
@@ -31,6 +39,16 @@ def mock_handler(file='handlers/mock.py', request='/mock', **response):
   handler.response_dict(**response)
   return handler
 
+def mock_request(page, url, cls=RequestHandler, **headers):
+  handler = cls.with_page(page)()
+  handler.initialize(Request.blank(url, headers=headers), Response())
+  handler.get(None)
+  return handler
+
+
+class CompressingHandler(RequestHandler):
+  compress = True
+
 
 def stub_memcache():
   try:
@@ -42,12 +60,29 @@ def stub_memcache():
 class TestMegaera(unittest.TestCase):
   def setUp(self):
     stub_memcache()
+    memcache.flush_all()
+    RequestHandler.handler_cache = HandlerCache()
   
   def test_with_page(self):
     page = mock_page()
     handler = RequestHandler.with_page(page)()
     self.assertEquals(handler.page, page)
   
+  def test_page_metadata(self):
+    page = mock_page('handlers/foo/bar.py')
+    page.get = lambda handler, response: None
+    cls = RequestHandler.with_page(page)
+    self.assertEquals(cls._page_name, 'foo/bar')
+    self.assertEquals(cls._page_templates, {'html': 'foo/bar.html', 'atom': 'foo/bar.atom'})
+    self.assertTrue(cls._page_has_get)
+    self.assertFalse(cls._page_has_post)
+  
+  def test_page_name(self):
+    handler = mock_handler(file='handlers/foo/bar.py')
+    self.assertEquals(handler.page_name(), 'foo/bar')
+    self.assertEquals(handler.page_name(page=mock_page('handlers/baz.py')), 'baz')
+    self.assertEquals(handler.cache_key(vary='qux'), 'foo/bar-qux')
+  
   def test_default_template(self):
     handler = mock_handler(file='handlers/foo/bar.py')
     template = handler.default_template()
@@ -70,6 +105,47 @@ class TestMegaera(unittest.TestCase):
     json_handler = mock_handler(request='/?json')
     self.assertTrue(json_handler.is_json())
   
+  def test_format(self):
+    self.assertEquals(mock_handler().format, 'html')
+    self.assertEquals(mock_handler(request='/mock?yaml').format, 'yaml')
+    self.assertEquals(mock_handler(request='/mock.xml').format, 'xml')
+    self.assertEquals(mock_handler(request='/mock.xml?json').format, 'json')
+    self.assertEquals(mock_handler(request='/mock.v2/foo').format, 'html')
+  
+  def test_format_accept(self):
+    def format(accept):
+      handler = mock_handler()
+      handler.request.headers['Accept'] = accept
+      return handler.format
+    self.assertEquals(format('application/json'), 'json')
+    self.assertEquals(format('application/json; charset=UTF-8'), 'json')
+    self.assertEquals(format('application/atom+xml'), 'atom')
+    self.assertEquals(format('*/*'), 'html')
+    self.assertEquals(format('application/json, */*;q=0.1'), 'json')
+    self.assertEquals(format('text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8'), 'html')
+    self.assertEquals(format('application/xml,application/xhtml+xml,text/html;q=0.9,*/*;q=0.5'), 'html')
+    self.assertEquals(format('application/xml;q=0.5, application/json;q=0.8'), 'json')
+    self.assertEquals(format('image/png'), 'html')
+  
+  def test_format_vary(self):
+    handler = mock_handler()
+    handler.request.headers['Accept'] = 'application/json'
+    self.assertEquals(handler.format, 'json')
+    self.assertEquals(handler.response.headers['Vary'], 'Accept')
+    handler.add_vary('accept-encoding')
+    handler.add_vary('Accept-Encoding')
+    self.assertEquals(handler.response.headers['Vary'], 'Accept, accept-encoding')
+    handler = mock_handler(request='/mock?json')
+    handler.request.headers['Accept'] = 'text/html'
+    self.assertEquals(handler.format, 'json')
+    self.assertFalse('Vary' in handler.response.headers)
+  
+  def test_accepts(self):
+    handler = mock_handler()
+    handler.request.headers['Accept'] = 'application/*;q=0.5, text/html;q=0'
+    self.assertTrue(handler.accepts('application/json'))
+    self.assertFalse(handler.accepts('text/html'))
+  
   def test_post_override(self):
     class PostClosure():
       is_post = False
@@ -86,6 +162,94 @@ class TestMegaera(unittest.TestCase):
     handler.render(None)
     self.assertEquals(jinja2.path, 'foo/bar.html')
   
+  def test_preload_templates(self):
+    import jinja2 as real_jinja2
+    from megaera import preload_templates
+    env = real_jinja2.Environment(loader=real_jinja2.DictLoader({
+      'foo/bar.html': 'hello {{ name }}',
+      'broken.html': '{% if %}',
+    }))
+    try:
+      self.assertEquals(preload_templates(env), frozenset(['foo/bar.html', 'broken.html']))
+      handler = mock_handler(file='handlers/foo/bar.py', name='world')
+      handler.file_exists = lambda path: self.fail('file_exists called')
+      self.assertTrue(handler.template_exists('foo/bar.html'))
+      self.assertFalse(handler.template_exists('foo/baz.html'))
+    finally:
+      set_jinja2_env(jinja2)
+  
+  def test_preload_templates_on_first_use(self):
+    import jinja2 as real_jinja2
+    from megaera import request_handler
+    env = real_jinja2.Environment(loader=real_jinja2.DictLoader({
+      'foo/bar.html': '{{ name|bold }}',
+    }))
+    os.environ['SERVER_SOFTWARE'] = 'Google App Engine/1.9.0'
+    try:
+      set_jinja2_env(env)
+      # added by the app once the environment is built
+      env.filters['bold'] = lambda s: '<b>%s</b>' % s
+      self.assertEquals(request_handler.__TEMPLATE_INDEX__, None)
+      handler = mock_handler(file='handlers/foo/bar.py')
+      handler.file_exists = lambda path: self.fail('file_exists called')
+      self.assertTrue(handler.template_exists('foo/bar.html'))
+      self.assertEquals(request_handler.__TEMPLATE_INDEX__, frozenset(['foo/bar.html']))
+      self.assertEquals(env.get_template('foo/bar.html').render(name='x'), '<b>x</b>')
+    finally:
+      del os.environ['SERVER_SOFTWARE']
+      set_jinja2_env(jinja2)
+  
+  def test_preload_unlisted_templates(self):
+    import jinja2 as real_jinja2
+    from megaera import request_handler
+    env = real_jinja2.Environment(loader=real_jinja2.FunctionLoader(
+      lambda name: name == 'foo/bar.html' and 'hello {{ name }}' or None))
+    os.environ['SERVER_SOFTWARE'] = 'Google App Engine/1.9.0'
+    try:
+      set_jinja2_env(env)
+      handler = mock_handler(file='handlers/foo/bar.py', name='world')
+      handler.file_exists = lambda path: path == os.path.join(request_handler.TEMPLATES_BASE, 'foo/bar.html')
+      handler.render(None)
+      self.assertEquals(handler.response.body, 'hello world')
+      self.assertEquals(request_handler.__TEMPLATE_INDEX__, None)
+    finally:
+      del os.environ['SERVER_SOFTWARE']
+      set_jinja2_env(jinja2)
+  
+  def test_stream_render(self):
+    import jinja2 as real_jinja2
+    env = real_jinja2.Environment(loader=real_jinja2.DictLoader({
+      'foo/bar.html': '{% for item in items %}<li>{{ item }}</li>{% endfor %}',
+      'foo/broken.html': 'before {{ missing.foo.bar }}',
+    }))
+    set_jinja2_env(env)
+    try:
+      handler = mock_handler(file='handlers/foo/bar.py', items=range(1000))
+      handler.stream_templates = True
+      handler.stream_buffer_size = 100
+      handler.file_exists = lambda path: True
+      writes = []
+      write = handler.response.out.write
+      handler.response.out.write = lambda text: writes.append(text) or write(text)
+      handler.render(None)
+      self.assertTrue(len(writes) > 1)
+      self.assertEquals(handler.response.body, ''.join('<li>%d</li>' % i for i in range(1000)))
+      # streamed output is neither hashed nor compressed
+      handler.request.headers['Accept-Encoding'] = 'gzip'
+      handler.compress = True
+      handler.finish()
+      self.assertFalse('ETag' in handler.response.headers)
+      self.assertFalse('Content-Encoding' in handler.response.headers)
+      # the partial output is dropped on errors
+      handler = mock_handler(file='handlers/foo/bar.py')
+      handler.stream_templates = True
+      handler.stream_buffer_size = 1
+      handler.file_exists = lambda path: True
+      handler.render('foo/broken.html')
+      self.assertTrue(handler.response.body.startswith('Template syntax error'))
+    finally:
+      set_jinja2_env(jinja2)
+  
   def test_atom_render(self):
     handler = mock_handler(file='handlers/foo/bar.py', request='/?atom')
     handler.file_exists = lambda self: True
@@ -93,6 +257,240 @@ class TestMegaera(unittest.TestCase):
     self.assertTrue(handler.is_atom())
     self.assertEquals(jinja2.path, 'foo/bar.atom')
   
+  def test_json_render(self):
+    handler = mock_handler(request='/?json', foo='bar')
+    handler.render(None)
+    self.assertEquals(handler.response.body, '{"foo":"bar"}')
+
+  def test_jsonp_render(self):
+    handler = mock_handler(request='/?json&callback=cb', foo='bar')
+    handler.render(None)
+    self.assertEquals(handler.response.body, 'cb({"foo":"bar"})')
+
+  def test_yaml_render(self):
+    handler = mock_handler(request='/?yaml', foo=['bar', 1])
+    handler.render(None)
+    self.assertEquals(handler.response.body, "foo:\n- bar\n- '1'\n")
+  
+  def test_xml_render(self):
+    handler = mock_handler(request='/?xml', foo=1)
+    handler.render(None)
+    self.assertTrue('<response>' in handler.response.body)
+    self.assertTrue('<foo>' in handler.response.body)
+  
+  def test_response_dict_class(self):
+    class ResponseDictHandler(RequestHandler):
+      response_dict_class = responsedict
+    handler = ResponseDictHandler.with_page(mock_page('handlers/mock.py'))()
+    handler.initialize(Request.blank('/?json'), Response())
+    self.assertTrue(isinstance(handler.response_dict(), responsedict))
+    handler.response_dict().messages.hello = 'hello'
+    handler.response_dict().errors
+    handler.render(None)
+    self.assertEquals(handler.response.body, '{"messages":{"hello":"hello"}}')
+  
+  def test_read_json(self):
+    handler = mock_handler()
+    handler.request.body = '{"foo": [1, 2]}'
+    self.assertEquals(handler.read_json(), dict(foo=[1, 2]))
+  
+  def test_read_json_items(self):
+    handler = mock_handler()
+    handler.request.body = '[{"foo": 1}, {"foo": 2}]'
+    self.assertEquals(list(handler.read_json(items=True)), [dict(foo=1), dict(foo=2)])
+  
+  def test_output_cache(self):
+    calls = []
+    def get(handler, response):
+      if handler.output_cached(vary='v'):
+        return
+      calls.append(handler.format)
+      response.foo = 'bar'
+      handler.cache_output(time=60, vary='v')
+    page = mock_page('handlers/output.py')
+    page.get = get
+    handler = mock_request(page, '/output?json')
+    self.assertEquals(handler.response.body, '{"foo":"bar"}')
+    handler = mock_request(page, '/output?json')
+    self.assertEquals(handler.response.body, '{"foo":"bar"}')
+    self.assertEquals(handler.response.headers['Content-Type'], 'application/json; charset=UTF-8')
+    self.assertEquals(calls, ['json'])
+    # keyed by format and callback
+    self.assertEquals(mock_request(page, '/output?json&callback=cb').response.body, 'cb({"foo":"bar"})')
+    self.assertEquals(mock_request(page, '/output?yaml').response.body, 'foo: bar\n')
+    self.assertEquals(len(calls), 3)
+    mock_request(page, '/output?json&no_cache')
+    self.assertEquals(len(calls), 4)
+    # invalidated with the page
+    handler.invalidate(vary='v')
+    mock_request(page, '/output?json&callback=cb')
+    self.assertEquals(len(calls), 5)
+  
+  def test_etag(self):
+    page = mock_page('handlers/etag.py')
+    page.get = lambda handler, response: response.update(foo='bar')
+    handler = mock_request(page, '/etag?json')
+    etag = handler.response.headers['ETag']
+    self.assertEquals(handler.response.body, '{"foo":"bar"}')
+    handler = mock_request(page, '/etag?json', If_None_Match=etag)
+    self.assertEquals(handler.response.status_int, 304)
+    self.assertEquals(handler.response.body, '')
+    handler = mock_request(page, '/etag?json', If_None_Match='"other"')
+    self.assertEquals(handler.response.status_int, 200)
+    self.assertEquals(handler.response.body, '{"foo":"bar"}')
+    self.assertNotEquals(mock_request(page, '/etag?yaml').response.headers['ETag'], etag)
+  
+  def test_not_modified(self):
+    calls = []
+    def get(handler, response):
+      if handler.not_modified(version=1, last_modified=datetime.datetime(2024, 1, 1)):
+        return
+      calls.append(handler.format)
+      response.foo = 'bar'
+    page = mock_page('handlers/not_modified.py')
+    page.get = get
+    handler = mock_request(page, '/not_modified?json')
+    etag = handler.response.headers['ETag']
+    self.assertEquals(handler.response.headers['Last-Modified'], 'Mon, 01 Jan 2024 00:00:00 GMT')
+    handler = mock_request(page, '/not_modified?json', If_None_Match=etag)
+    self.assertEquals(handler.response.status_int, 304)
+    handler = mock_request(page, '/not_modified?json', If_Modified_Since='Tue, 02 Jan 2024 00:00:00 GMT')
+    self.assertEquals(handler.response.status_int, 304)
+    handler = mock_request(page, '/not_modified?json', If_Modified_Since='Sun, 31 Dec 2023 00:00:00 GMT')
+    self.assertEquals(handler.response.status_int, 200)
+    # keyed by format
+    handler = mock_request(page, '/not_modified?yaml', If_None_Match=etag)
+    self.assertEquals(handler.response.status_int, 200)
+    self.assertEquals(calls, ['json', 'json', 'yaml'])
+  
+  def test_not_modified_compressed(self):
+    calls = []
+    def get(handler, response):
+      if handler.not_modified(version=1):
+        return
+      calls.append(handler.format)
+      response.foo = 'bar' * 1000
+    page = mock_page('handlers/not_modified_compressed.py')
+    page.get = get
+    handler = mock_request(page, '/not_modified_compressed?json', cls=CompressingHandler, Accept_Encoding='gzip')
+    self.assertEquals(handler.response.headers['Content-Encoding'], 'gzip')
+    etag = handler.response.headers['ETag']
+    handler = mock_request(page, '/not_modified_compressed?json', cls=CompressingHandler, Accept_Encoding='gzip', If_None_Match=etag)
+    self.assertEquals(handler.response.status_int, 304)
+    self.assertEquals(handler.response.headers['ETag'], etag)
+    # the plain representation has its own ETag
+    handler = mock_request(page, '/not_modified_compressed?json', cls=CompressingHandler, If_None_Match=etag)
+    self.assertEquals(handler.response.status_int, 200)
+    self.assertEquals(calls, ['json', 'json'])
+  
+  def test_output_cache_etag(self):
+    calls = []
+    def get(handler, response):
+      if handler.output_cached():
+        return
+      calls.append(handler.format)
+      response.foo = 'bar'
+      handler.cache_output(time=60)
+    page = mock_page('handlers/output_etag.py')
+    page.get = get
+    etag = mock_request(page, '/output_etag?json').response.headers['ETag']
+    handler = mock_request(page, '/output_etag?json', If_None_Match=etag)
+    self.assertEquals(handler.response.status_int, 304)
+    self.assertEquals(handler.response.body, '')
+    self.assertEquals(len(calls), 1)
+  
+  def test_compression(self):
+    calls = []
+    def get(handler, response):
+      if handler.output_cached():
+        return
+      calls.append(handler.format)
+      response.foo = 'bar' * 1000
+      handler.cache_output(time=60)
+    page = mock_page('handlers/compressed.py')
+    page.get = get
+    body = '{"foo":"%s"}' % ('bar' * 1000)
+    handler = mock_request(page, '/compressed?json', cls=CompressingHandler, Accept_Encoding='gzip, deflate')
+    self.assertEquals(handler.response.headers['Content-Encoding'], 'gzip')
+    self.assertEquals(handler.response.headers['Vary'], 'Accept-Encoding')
+    self.assertEquals(zlib.decompress(handler.response.body, 16 + zlib.MAX_WBITS), body)
+    etag = handler.response.headers['ETag']
+    # served compressed from the output cache
+    handler = mock_request(page, '/compressed?json', cls=CompressingHandler, Accept_Encoding='gzip')
+    self.assertEquals(zlib.decompress(handler.response.body, 16 + zlib.MAX_WBITS), body)
+    self.assertEquals(handler.response.headers['ETag'], etag)
+    self.assertEquals(mock_request(page, '/compressed?json', cls=CompressingHandler, Accept_Encoding='gzip', If_None_Match=etag).response.status_int, 304)
+    handler = mock_request(page, '/compressed?json', cls=CompressingHandler, Accept_Encoding='deflate')
+    self.assertEquals(handler.response.headers['Content-Encoding'], 'deflate')
+    self.assertEquals(zlib.decompress(handler.response.body), body)
+    self.assertNotEquals(handler.response.headers['ETag'], etag)
+    handler = mock_request(page, '/compressed?json', cls=CompressingHandler, Accept_Encoding='gzip;q=0')
+    self.assertFalse('Content-Encoding' in handler.response.headers)
+    self.assertEquals(handler.response.body, body)
+    self.assertEquals(calls, ['json'])
+  
+  def test_compression_off(self):
+    handler = mock_handler(request='/mock?json', foo='bar' * 1000)
+    handler.request.headers['Accept-Encoding'] = 'gzip'
+    handler.render(None)
+    handler.finish()
+    self.assertFalse('Content-Encoding' in handler.response.headers)
+    self.assertEquals(handler.response.body, '{"foo":"%s"}' % ('bar' * 1000))
+  
+  def test_compression_min_size(self):
+    handler = mock_handler(request='/mock?json', foo='bar')
+    handler.compress = True
+    handler.request.headers['Accept-Encoding'] = 'gzip'
+    handler.render(None)
+    handler.finish()
+    self.assertFalse('Content-Encoding' in handler.response.headers)
+    self.assertEquals(handler.response.body, '{"foo":"bar"}')
+  
+  def test_timing(self):
+    def get(handler, response):
+      handler.cached()
+      response.foo = 'bar'
+      handler.cache(foo='bar')
+    page = mock_page('handlers/timed.py')
+    page.get = get
+    reported = []
+    handler = RequestHandler.with_page(page)()
+    handler.timing = True
+    handler.timing_log = False
+    handler.timing_hooks = (lambda handler, timings: reported.append(timings.items()),)
+    handler.initialize(Request.blank('/timed?json'), Response())
+    handler.get(None)
+    header = handler.response.headers['Server-Timing']
+    self.assertEquals([metric.split(';')[0] for metric in header.split(', ')],
+      ['handler', 'cache', 'json', 'etag', 'total'])
+    self.assertTrue('cache;dur=' in header and ';desc="2"' in header)
+    self.assertEquals([(name, count) for name, elapsed, count in reported[0]],
+      [('handler', 1), ('cache', 2), ('json', 1), ('etag', 1), ('total', 1)])
+  
+  def test_timing_dispatch(self):
+    started = []
+    class TimedHandler(RequestHandler):
+      timing = True
+      timing_log = False
+      def get(self, *args):
+        started.append(self._timings)
+        return super(TimedHandler, self).get(*args)
+    page = mock_page('handlers/timed.py')
+    page.get = lambda handler, response: response.update(foo='bar')
+    app = webapp2.WSGIApplication([('/timed', TimedHandler.with_page(page))])
+    response = Request.blank('/timed?json').get_response(app)
+    # the timings start before the handler method runs
+    self.assertTrue(started[0] is not None)
+    self.assertTrue('total;dur=' in response.headers['Server-Timing'])
+  
+  def test_timing_disabled(self):
+    handler = mock_handler(request='/mock?json')
+    self.assertTrue(handler.timed('handler') is handler.timed('json'))
+    handler.render(None)
+    handler.finish()
+    self.assertFalse('Server-Timing' in handler.response.headers)
+    self.assertEquals(handler._timings, None)
+  
   def test_cache(self):
     handler = mock_handler()
     handler.cache(foo='foo')
@@ -121,6 +519,44 @@ class TestMegaera(unittest.TestCase):
     handler.invalidate(vary='bar')
     self.assertFalse(handler.cached())
   
+  def test_cached_twice(self):
+    handler = mock_handler()
+    handler.handler_cache = HandlerCache(wait_timeout=60)
+    self.assertFalse(handler.cached())
+    # holds the lease, doesn't wait for itself
+    self.assertFalse(handler.cached())
+    handler.cache(foo='foo')
+    self.assertTrue(mock_handler().cached())
+  
+  def test_cache_many(self):
+    handler = mock_handler()
+    handler.cache_many({'a': dict(foo='foo'), 'b': dict(bar='bar')})
+    handler = mock_handler()
+    get_multi = memcache.get_multi
+    calls = []
+    def counting_get_multi(*args, **kwargs):
+      calls.append(args)
+      return get_multi(*args, **kwargs)
+    memcache.get_multi = counting_get_multi
+    try:
+      self.assertEquals(handler.cached_many(['a', 'b', 'c']), set(['a', 'b']))
+    finally:
+      memcache.get_multi = get_multi
+    self.assertEquals(len(calls), 1)
+    self.assertEquals(handler.response_dict().foo, 'foo')
+    self.assertEquals(handler.response_dict().bar, 'bar')
+    handler.release_leases()
+  
+  def test_cache_invalidate_many(self):
+    handler = mock_handler()
+    handler.cache_many({'a': dict(foo='foo'), 'b': dict(bar='bar')})
+    handler.cache(baz='baz')
+    handler = mock_handler()
+    handler.invalidate_many(['a', handler.page])
+    self.assertEquals(handler.cached_many(['a', 'b']), set(['b']))
+    self.assertFalse(handler.cached())
+    handler.release_leases()
+  
 
 if __name__ == '__main__':
   unittest.main()
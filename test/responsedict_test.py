@@ -0,0 +1,103 @@
+import pickle
+import unittest
+import yaml
+
+from megaera.responsedict import responsedict
+from megaera.recursivedefaultdict import recursivedefaultdict
+from megaera.sanitize import sanitize, dump_json, dump_yaml
+from megaera import to_xml
+
+
+def urlize(path):
+  return path
+
+
+class TestResponseDict(unittest.TestCase):
+  def test_dot_access(self):
+    response = responsedict()
+    response.foo = 'bar'
+    self.assertEquals(response.foo, 'bar')
+    self.assertEquals(response, dict(foo='bar'))
+    del response.foo
+    self.assertEquals(response, {})
+
+  def test_read_leaves_nothing_behind(self):
+    response = responsedict()
+    self.assertFalse(response.messages)
+    self.assertFalse(response.messages.hello)
+    self.assertEquals(response, {})
+
+  def test_write_creates_children(self):
+    response = responsedict()
+    response.messages.hello = 'hello'
+    response.a.b.c = 'd'
+    self.assertEquals(response, dict(messages=dict(hello='hello'), a=dict(b=dict(c='d'))))
+    self.assertTrue(isinstance(response.messages, responsedict))
+
+  def test_reads_return_the_same_child(self):
+    for response in (responsedict(), recursivedefaultdict()):
+      errors = response.errors
+      response.errors.email = 'bad'
+      errors.name = 'required'
+      self.assertEquals(response, dict(errors=dict(email='bad', name='required')))
+
+  def test_replaced_child(self):
+    response = responsedict()
+    errors = response.errors
+    response.errors = 'none'
+    errors.name = 'required'
+    self.assertEquals(response, dict(errors='none'))
+    response = responsedict()
+    errors = response.errors
+    response.update(errors='none')
+    errors.name = 'required'
+    self.assertEquals(response, dict(errors='none'))
+
+  def test_update_creates_children(self):
+    response = responsedict()
+    response.errors.update(name='required')
+    self.assertEquals(response, dict(errors=dict(name='required')))
+
+  def test_missing_dunder(self):
+    self.assertFalse(hasattr(responsedict(), '__html__'))
+    self.assertRaises(AttributeError, delattr, responsedict(), 'foo')
+
+  def test_pickle(self):
+    response = responsedict()
+    response.foo.bar = 'baz'
+    unpickled = pickle.loads(pickle.dumps(response, 2))
+    self.assertEquals(unpickled, response)
+    unpickled.qux.quux = 1
+    self.assertEquals(unpickled.qux, dict(quux=1))
+
+
+class TestPhantoms(unittest.TestCase):
+  def response(self):
+    response = recursivedefaultdict()
+    response.foo = 'bar'
+    # reading leaves an empty child behind
+    response.messages.hello
+    return response
+
+  def test_sanitize(self):
+    self.assertEquals(sanitize(self.response(), urlize), dict(foo='bar'))
+
+  def test_json(self):
+    self.assertEquals(dump_json(self.response(), urlize), '{"foo":"bar"}')
+
+  def test_yaml(self):
+    self.assertEquals(yaml.safe_load(dump_yaml(self.response(), urlize)), dict(foo='bar'))
+
+  def test_xml(self):
+    self.assertFalse('messages' in to_xml(self.response(), urlize=urlize))
+
+  def test_not_phantom(self):
+    response = self.response()
+    response.messages.bye = 'bye'
+    self.assertEquals(
+      sanitize(response, urlize),
+      dict(foo='bar', messages=dict(bye='bye')))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,96 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from megaera import request_handler, routing
+
+from google.appengine.ext.webapp import Request, Response
+
+
+
+PAGES = {
+  'routedpages/__init__.py': '',
+  'routedpages/default.py': 'def get(handler, response):\n  response.page = "default"\n',
+  'routedpages/something.py': 'def get(handler, response):\n  response.page = "something"\n',
+  'routedpages/foo/__init__.py': '',
+  'routedpages/foo/default.py': 'def get(handler, response):\n  response.page = "foo"\n',
+  'routedpages/foo/bar.py': 'def get(handler, response):\n  response.page = "foo/bar"\n',
+  'routedpages/notapackage/baz.py': '',
+}
+
+
+class RoutedPagesTestCase(unittest.TestCase):
+  """Runs with the pages above as HANDLERS_BASE."""
+  
+  def setUp(self):
+    self.cwd = os.getcwd()
+    self.dir = tempfile.mkdtemp()
+    for path, source in PAGES.items():
+      path = os.path.join(self.dir, path)
+      if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+      open(path, 'w').write(source)
+    os.chdir(self.dir)
+    sys.path.insert(0, self.dir)
+    self.handlers_base = request_handler.HANDLERS_BASE
+    request_handler.HANDLERS_BASE = 'routedpages'
+  
+  def tearDown(self):
+    request_handler.HANDLERS_BASE = self.handlers_base
+    sys.path.remove(self.dir)
+    os.chdir(self.cwd)
+    shutil.rmtree(self.dir)
+    for name in list(sys.modules):
+      if name.startswith('routedpages'):
+        del sys.modules[name]
+
+
+class TestRouting(RoutedPagesTestCase):
+  def test_page_modules(self):
+    self.assertEquals(routing.page_modules(), [
+      'routedpages.default', 'routedpages.something',
+      'routedpages.foo.bar', 'routedpages.foo.default'])
+  
+  def test_page_path(self):
+    self.assertEquals(routing.page_path('routedpages.default'), '/')
+    self.assertEquals(routing.page_path('routedpages.something'), '/something')
+    self.assertEquals(routing.page_path('routedpages.foo.default'), '/foo')
+    self.assertEquals(routing.page_path('routedpages.foo.bar'), '/foo/bar')
+  
+  def test_match(self):
+    table = routing.build_routes()
+    def match(path):
+      matched = table.match(Request.blank(path))
+      return matched and (matched[0].template, matched[1])
+    self.assertEquals(match('/'), ('/', (None,)))
+    self.assertEquals(match('/foo/bar'), ('/foo/bar', (None,)))
+    self.assertEquals(match('/foo/bar.json'), ('/foo/bar', ('json',)))
+    self.assertEquals(match('/.xml'), ('/', ('xml',)))
+    self.assertEquals(match('/missing'), None)
+    self.assertEquals(match('/missing.json'), None)
+  
+  def test_lazy(self):
+    table = routing.build_routes()
+    handler_class = table.match(Request.blank('/foo/bar'))[0].handler
+    self.assertFalse('routedpages.foo.bar' in sys.modules)
+    self.assertEquals(handler_class._page_name, 'foo/bar')
+    handler = handler_class()
+    handler.initialize(Request.blank('/foo/bar.json'), Response())
+    self.assertTrue('routedpages.foo.bar' in sys.modules)
+    self.assertEquals(handler.page, sys.modules['routedpages.foo.bar'])
+    self.assertEquals(handler._page_name, 'foo/bar')
+    handler.get('json')
+    self.assertEquals(handler.response.body, '{"page":"foo/bar"}')
+  
+  def test_application(self):
+    import webapp2
+    app = webapp2.WSGIApplication([routing.build_routes()])
+    response = Request.blank('/something.json').get_response(app)
+    self.assertEquals(response.body, '{"page":"something"}')
+    self.assertEquals(Request.blank('/missing').get_response(app).status_int, 404)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,110 @@
+import unittest
+import yaml
+
+from megaera.sanitize import sanitize, LazySequence, dump_json, dump_yaml
+from megaera import json, to_xml
+
+
+def urlize(path):
+  return 'http://example.com' + path
+
+class Model(object):
+  def __init__(self, name):
+    self.name = name
+  def sanitize(self, urlize):
+    return dict(name=self.name, url=urlize('/model/' + self.name), size=len(self.name))
+
+class OldModel:
+  def __init__(self, name):
+    self.name = name
+  def sanitize(self, urlize):
+    return dict(name=self.name)
+
+class OldValue:
+  def __str__(self):
+    return 'old'
+
+RESPONSE = dict(
+  foo=[1, (2.5, dict(bar=None))],
+  models=[Model('foo'), Model('quux')],
+  model=Model('bar'),
+  empty={},
+  flag=True,
+)
+
+
+class TestSanitize(unittest.TestCase):
+  def test_stringify(self):
+    self.assertEquals(sanitize(1, urlize), '1')
+    self.assertEquals(sanitize(None, urlize), 'None')
+
+  def test_nested(self):
+    self.assertEquals(
+      sanitize(dict(foo=[1, (2, dict(bar=3))]), urlize),
+      dict(foo=['1', ['2', dict(bar='3')]]))
+
+  def test_sanitizeable(self):
+    self.assertEquals(
+      sanitize([Model('foo')], urlize),
+      [dict(name='foo', url='http://example.com/model/foo', size=3)])
+
+  def test_old_style(self):
+    self.assertEquals(
+      sanitize([OldModel('foo'), OldValue()], urlize),
+      [dict(name='foo'), 'old'])
+    self.assertEquals(dump_json(dict(a=OldModel('foo')), urlize), '{"a":{"name":"foo"}}')
+    self.assertEquals(yaml.safe_load(dump_yaml(dict(a=OldModel('foo')), urlize)), dict(a=dict(name='foo')))
+    self.assertTrue('<name>' in to_xml(dict(a=OldModel('foo')), urlize=urlize))
+
+  def test_deep(self):
+    value = []
+    for i in range(10000):
+      value = [value]
+    sanitized = sanitize(value, urlize)
+    for i in range(10000):
+      sanitized = sanitized[0]
+    self.assertEquals(sanitized, [])
+
+  def test_lazy(self):
+    consumed = []
+    def generate():
+      for i in range(3):
+        consumed.append(i)
+        yield i
+    sanitized = sanitize(dict(foo=generate()), urlize, lazy=True)
+    self.assertTrue(isinstance(sanitized['foo'], LazySequence))
+    self.assertEquals(consumed, [])
+    self.assertEquals(json.write(sanitized), '{"foo":["0","1","2"]}')
+    self.assertEquals(consumed, [0, 1, 2])
+
+  def test_not_lazy(self):
+    sanitized = sanitize(dict(foo=iter([1, 2])), urlize)
+    self.assertEquals(sanitized, dict(foo=['1', '2']))
+
+
+class TestFusedSanitize(unittest.TestCase):
+  def test_json(self):
+    self.assertEquals(
+      json.read(dump_json(RESPONSE, urlize)),
+      json.read(json.write(sanitize(RESPONSE, urlize))))
+
+  def test_json_lazy(self):
+    value = dict(foo=(Model(str(i)) for i in range(3)))
+    self.assertEquals(
+      dump_json(value, urlize),
+      json.write(dict(foo=[Model(str(i)).sanitize(urlize) for i in range(3)])))
+
+  def test_yaml(self):
+    self.assertEquals(
+      dump_yaml(RESPONSE, urlize, default_flow_style=False),
+      yaml.safe_dump(sanitize(RESPONSE, urlize), default_flow_style=False))
+
+  def test_xml(self):
+    for key, value in RESPONSE.iteritems():
+      self.assertEquals(
+        to_xml({key: value}, urlize=urlize),
+        to_xml(sanitize({key: value}, urlize)))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -2,6 +2,7 @@
 
 
 import unittest
+from StringIO import StringIO
 
 from megaera import to_xml
 
@@ -106,6 +107,44 @@ u"""<?xml version="1.0" ?>
 </data>
 """.encode('utf8'),
     )
+  def test_escape(self):
+    self.assertEquals(
+      to_xml(dict(foo='<a href="b">&</a>')),
+u"""<?xml version="1.0" ?>
+<data>
+  <foo>
+    &lt;a href=&quot;b&quot;&gt;&amp;&lt;/a&gt;
+  </foo>
+</data>
+""".encode('utf8'),
+    )
+  def test_empty(self):
+    self.assertEquals(
+      to_xml(dict(foo={})),
+u"""<?xml version="1.0" ?>
+<data>
+  <foo/>
+</data>
+""".encode('utf8'),
+    )
+    self.assertEquals(
+      to_xml([[]]),
+u"""<?xml version="1.0" ?>
+<data>
+  <value/>
+</data>
+""".encode('utf8'),
+    )
+  def test_compact(self):
+    self.assertEquals(
+      to_xml(dict(foo=['bar', ['baz']]), pretty=False),
+      '<?xml version="1.0" ?><data><foo>bar</foo><value><value>baz</value></value></data>',
+    )
+  def test_out(self):
+    out = StringIO()
+    value = dict(foo=range(1000))
+    self.assertEquals(to_xml(value, out=out), None)
+    self.assertEquals(out.getvalue(), to_xml(value))
 
 if __name__ == '__main__':
   unittest.main()
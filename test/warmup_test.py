@@ -0,0 +1,33 @@
+import sys
+
+import webapp2
+
+from megaera import routing, WARMUP_ROUTE
+from megaera.warmup import warmup
+
+from google.appengine.ext.webapp import Request
+
+from test.routing_test import RoutedPagesTestCase
+
+
+class TestWarmup(RoutedPagesTestCase):
+  def test_warmup(self):
+    timings = warmup()
+    self.assertEquals([phase for phase, elapsed in timings], ['handlers', 'templates', 'config'])
+    self.assertTrue('routedpages.foo.bar' in sys.modules)
+  
+  def test_warmup_routes(self):
+    table = routing.build_routes()
+    warmup([table])
+    self.assertTrue('routedpages.something' in sys.modules)
+    handler_class = table.match(Request.blank('/something'))[0].handler
+    self.assertEquals(handler_class._page_module, None)
+    self.assertEquals(handler_class.page, sys.modules['routedpages.something'])
+  
+  def test_warmup_handler(self):
+    app = webapp2.WSGIApplication([WARMUP_ROUTE, routing.build_routes()])
+    response = Request.blank('/_ah/warmup').get_response(app)
+    self.assertEquals(response.status_int, 200)
+    self.assertEquals([line.split(':')[0] for line in response.body.splitlines()],
+      ['handlers', 'templates', 'config'])
+    self.assertTrue('routedpages.default' in sys.modules)